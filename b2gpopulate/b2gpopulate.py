@@ -5,22 +5,37 @@
 # 2) adb forward tcp:2828 tcp:2828
 
 import argparse
+import hashlib
 import json
+import multiprocessing
 import os
-import pkg_resources
 import posixpath
 import re
+from Queue import Empty
+from Queue import Queue
 import shutil
+from StringIO import StringIO
 import sys
 import tempfile
+import threading
+import time
+import zlib
 from zipfile import ZipFile
+from zipfile import ZIP_DEFLATED
+from zipfile import ZIP_STORED
 
-from marionette import Marionette
-import mozdevice
-import mozlog
-from mozlog import structured
-from gaiatest import GaiaData
-from gaiatest import GaiaDevice
+# marionette, mozdevice, mozlog and gaiatest are imported where they are
+# used, so that the command line is quick to start when it only validates
+# its arguments or prints what it would do
+import delta
+import id3
+import idb
+from journal import DEFAULT_DIR as JOURNAL_DIR
+from journal import Journal
+from journal import journal_path
+from metrics import Metrics
+import planner
+import variants
 
 WORKLOADS = {
     'empty': {
@@ -65,6 +80,122 @@ WORKLOADS = {
         'event': 3200}
 }
 
+# IndexedDB database for each data type: the resource it is prebuilt in,
+# the object store holding its records, and whether generated records
+# should extend the template's keys downwards (calls are keyed by date)
+DATABASES = {
+    'call': ('dialerDb', 'dialerRecents', True),
+    'contact': ('contactsDb', 'contacts', False),
+    'event': ('calendarDb', 'events', False),
+    'message': ('smsDb', 'sms', False)}
+
+# apps whose own storage holds a database, rather than that of chrome
+DATABASE_APPS = {
+    'call': 'communications.gaiamobile.org',
+    'event': 'calendar.gaiamobile.org'}
+
+MEDIA_STORAGES = {
+    'music': 'music',
+    'picture': 'pictures',
+    'video': 'videos'}
+
+# packaged files needed to populate each data type, besides its databases
+RESOURCES = {
+    'contact': ['contactsPictures.zip'],
+    'message': ['smsAttachments.zip'],
+    'music': ['MUS_0001.mp3'],
+    'picture': ['IMG_0001.jpg'],
+    'video': ['VID_0001.3gp']}
+
+# seconds to wait for B2G to index pushed media before checking its counts
+DEFAULT_INDEX_TIMEOUT = 300
+
+# DCF directories are numbered from 100 to 999
+LAST_DCF_DIRECTORY = 999
+
+# sharded videos are placed in DCF directories from this one on, which
+# leaves the directories before it to pictures
+FIRST_VIDEO_DIRECTORY = 550
+
+TRACKS_PER_ALBUM = 10
+
+# Counts the records of each database and the files of each media type in
+# a single round trip. Runs in the chrome context so that it can open the
+# databases of any app.
+COUNT_SCRIPT = """
+Components.utils.import('resource://gre/modules/Services.jsm');
+let [databases, media] = arguments;
+let counts = {};
+let pending = databases.length + media.length;
+function done(name, count) {
+  counts[name] = count;
+  if (--pending === 0) {
+    marionetteScriptFinished(counts);
+  }
+}
+if (pending === 0) {
+  marionetteScriptFinished(counts);
+}
+databases.forEach(function(db) {
+  let ssm = Services.scriptSecurityManager;
+  let principal = db.origin ?
+    ssm.getAppCodebasePrincipal(Services.io.newURI(db.origin, null, null),
+                                db.appId, false) :
+    ssm.getSystemPrincipal();
+  let request = indexedDB.openForPrincipal(principal, db.name);
+  request.onupgradeneeded = function() {
+    // the database is missing, so do not create it
+    request.transaction.abort();
+  };
+  request.onsuccess = function() {
+    let database = request.result;
+    let count = database.transaction(db.store).objectStore(db.store).count();
+    count.onsuccess = function() {
+      database.close();
+      done(db.type, count.result);
+    };
+    count.onerror = function() {
+      database.close();
+      done(db.type, null);
+    };
+  };
+  request.onerror = function() {
+    done(db.type, null);
+  };
+});
+let win = Services.wm.getMostRecentWindow('navigator:browser');
+media.forEach(function(medium) {
+  let count = 0;
+  let cursor = win.navigator.getDeviceStorage(medium[1]).enumerate();
+  cursor.onsuccess = function() {
+    let file = cursor.result;
+    if (!file) {
+      done(medium[0], count);
+      return;
+    }
+    // 3gp is both music and video, but only counted as video
+    if (!(medium[0] === 'music' && file.name.slice(-4) === '.3gp')) {
+      count++;
+    }
+    cursor.continue();
+  };
+  cursor.onerror = function() {
+    done(medium[0], null);
+  };
+});
+"""
+
+# rough costs used to estimate a plan before running it
+ESTIMATED_PUSH_RATE = 2 * 1024 * 1024  # bytes per second over adb
+ESTIMATED_EXTRACT_RATE = 20 * 1024 * 1024  # bytes per second
+ESTIMATED_GENERATE_RATE = 1500  # records per second
+ESTIMATED_TAG_TIME = 0.001  # seconds per music track
+ESTIMATED_VARIANT_TIME = 0.0005  # seconds per picture or video variant
+ESTIMATED_COMMAND_TIME = 0.1  # seconds per adb command
+ESTIMATED_COPY_RATE = 20 * 1024 * 1024  # bytes per second on the device
+ESTIMATED_STOP_TIME = 5
+ESTIMATED_START_TIME = 30
+
 
 class B2GPopulateError(Exception):
     def __init__(self, message):
@@ -72,39 +203,741 @@ class B2GPopulateError(Exception):
 
 
 class IncorrectCountError(B2GPopulateError):
-    """Exception for a count being incorrect"""
-    def __init__(self, file_type, expected, actual):
-        Exception.__init__(
-            self, 'Incorrect number of %s. Expected %s but found %s' % (
-                file_type, expected, actual))
+    """Exception for one or more counts being incorrect
+
+    Takes either a single type with its expected and actual counts, or a
+    list of (type, expected, actual) mismatches.
+    """
+    def __init__(self, file_type, expected=None, actual=None):
+        if isinstance(file_type, list):
+            self.mismatches = file_type
+        else:
+            self.mismatches = [(file_type, expected, actual)]
+        Exception.__init__(self, '\n'.join([
+            'Incorrect number of %s. Expected %s but found %s' % mismatch
+            for mismatch in self.mismatches]))
 
 
 class InvalidCountError(B2GPopulateError):
     def __init__(self, data_type):
         Exception.__init__(
-            self, 'Invalid value for %s count, use one of: %s' % (
-                data_type,
-                sorted([WORKLOADS[k][data_type] for k in WORKLOADS.keys()])))
+            self, 'Invalid value for %s count, must not be negative' % (
+                data_type))
+
+
+class TransferError(B2GPopulateError):
+    """Exception for one or more transfers failing"""
+    def __init__(self, errors):
+        self.errors = errors
+        Exception.__init__(
+            self, '%d transfer%s failed:\n%s' % (
+                len(errors), '' if len(errors) == 1 else 's',
+                '\n'.join(['%s: %s' % error for error in errors])))
+
+
+class TransferScheduler(object):
+    """Run device transfers on a bounded pool of threads
+
+    Each task is a single adb operation, such as pushing a file or a whole
+    directory, so only independent resources are transferred in parallel.
+    Failures are collected per task and raised together as a TransferError
+    once every task has been attempted.
+    """
+
+    def __init__(self, logger, jobs=1):
+        self.logger = logger
+        self.jobs = max(1, jobs)
+        self.tasks = []
+
+    def add(self, name, func, args=(), size=0, files=1):
+        self.tasks.append((name, func, args, size, files))
+
+    def push_file(self, manager, local, remote):
+        self.add(remote, manager.pushFile, (local, remote),
+                 os.path.getsize(local))
+
+    def push_dir(self, manager, local_dir, remote_dir):
+        size, files = disk_usage(local_dir)
+        self.add(remote_dir, manager.pushDir, (local_dir, remote_dir), size,
+                 files)
+
+    def run(self, action='Transferred'):
+        queue = Queue()
+        for task in self.tasks:
+            queue.put(task)
+        self.tasks = []
+        lock = threading.Lock()
+        errors = []
+        totals = {'files': 0, 'bytes': 0}
+
+        def worker():
+            while True:
+                try:
+                    name, func, args, size, files = queue.get_nowait()
+                except Empty:
+                    return
+                try:
+                    func(*args)
+                except Exception as e:
+                    self.logger.debug('Failed %s: %s' % (name, e))
+                    with lock:
+                        errors.append((name, e))
+                else:
+                    with lock:
+                        totals['files'] += files
+                        totals['bytes'] += size
+
+        threads = [threading.Thread(target=worker) for i in range(
+            min(self.jobs, queue.qsize()))]
+        start = time.time()
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            # joining with a timeout lets KeyboardInterrupt through
+            while thread.is_alive():
+                thread.join(0.5)
+        elapsed = time.time() - start
+        if totals['bytes']:
+            self.logger.info(
+                '%s %d files (%d bytes) in %.2fs using %d jobs '
+                '(%.1f KB/s)' % (
+                    action, totals['files'], totals['bytes'], elapsed,
+                    len(threads),
+                    totals['bytes'] / 1024.0 / elapsed if elapsed else 0))
+        else:
+            self.logger.info('%s %d files in %.2fs using %d jobs' % (
+                action, totals['files'], elapsed, len(threads)))
+        if errors:
+            raise TransferError(errors)
+        return totals
+
+
+def duplicate_names(filename, count):
+    """Return the names gaiatest's file manager gives to copies of a file"""
+    if count == 1:
+        return [filename]
+    names = []
+    for i in range(1, count + 1):
+        # Make the remote filename unique by including an index
+        if '.' in filename:
+            names.append('_%d.'.join(iter(filename.rsplit('.', 1))) % i)
+        else:
+            names.append('%s_%d' % (filename, i))
+    return names
+
+
+def track_names(filename, count):
+    """Return the names of count tagged copies of a track, which unlike
+    duplicate_names are numbered even if there is only one"""
+    base, dot, extension = filename.rpartition('.')
+    return [dot and '%s_%d.%s' % (base, i, extension) or
+            '%s_%d' % (filename, i) for i in range(1, count + 1)]
+
+
+def shards(count, files_per_directory=None):
+    """Return the first and last number of the copies in each directory
+
+    Copies are numbered from 1 as they are by duplicate_names, and are all
+    placed in one directory unless files_per_directory is given.
+    """
+    if not files_per_directory or count <= 1:
+        return [(1, count)]
+    return [(first, min(first + files_per_directory - 1, count))
+            for first in range(1, count + 1, files_per_directory)]
+
+
+def shard_directories(destination, count):
+    """Return the directories that count shards of destination are placed in
+
+    A DCF directory such as DCIM/100MZLLA is followed by 101MZLLA and so on,
+    as a camera would do once a directory is full, stopping short of the
+    directories of videos. Any other destination is given numbered
+    subdirectories.
+    """
+    if count == 1:
+        return [destination]
+    parent, name = posixpath.split(destination)
+    match = re.match(r'(\d{3})(\w{5})$', name)
+    if match is None:
+        return [posixpath.join(destination, '%03d' % i)
+                for i in range(1, count + 1)]
+    first = int(match.group(1))
+    last = LAST_DCF_DIRECTORY
+    if first < FIRST_VIDEO_DIRECTORY:
+        last = FIRST_VIDEO_DIRECTORY - 1
+    if first + count - 1 > last:
+        raise B2GPopulateError(
+            'Unable to place %d directories after %s' % (count, destination))
+    return [posixpath.join(parent, '%03d%s' % (first + i, match.group(2)))
+            for i in range(count)]
+
+
+def album_directory(album):
+    return 'Album_%d' % album
+
+
+def required_resources(resources, data_type):
+    """Return the packaged files needed to populate a data type"""
+    paths = [resources.resource(name) for name in
+             RESOURCES.get(data_type, [])]
+    if data_type in DATABASES:
+        paths.append(resources.database_archive(DATABASES[data_type][0]))
+    return paths
+
+
+def missing_resources(resources, data_types):
+    """Return the data types that cannot be populated as some of their
+    packaged resources are missing"""
+    return [data_type for data_type in sorted(data_types) if not all(
+        [os.path.exists(path) for path in
+         required_resources(resources, data_type)])]
+
+
+def media_directory(file_type, files_per_directory=None):
+    """Return the DCF directory that pictures or videos are placed in
+
+    Both are placed in DCIM/100MZLLA as a camera would place them, unless
+    they are sharded, in which case videos are given directories of their
+    own so that no directory holds more than files_per_directory files.
+    """
+    if file_type == 'video' and files_per_directory:
+        return 'DCIM/%03dMZLLA' % FIRST_VIDEO_DIRECTORY
+    return 'DCIM/100MZLLA'
+
+
+def template_marker(data_type, count):
+    """Return the prebuilt database count to create count records from"""
+    markers = sorted(set([WORKLOADS[k][data_type] for k in WORKLOADS]))
+    if count in markers:
+        return count
+    lower = [marker for marker in markers if 0 < marker <= count]
+    return lower and lower[-1] or [m for m in markers if m > 0][0]
+
+
+def default_logger():
+    """Return the structured logger set up by the command line, if any"""
+    import mozlog
+    from mozlog import structured
+    return structured.get_default_logger(component='b2gpopulate') or \
+        mozlog.getLogger('b2gpopulate')
+
+
+def disk_usage(path):
+    """Return the size in bytes and number of files of a file or tree"""
+    if not os.path.isdir(path):
+        return os.path.getsize(path), 1
+    size = files = 0
+    for root, dirs, filenames in os.walk(path):
+        size += sum([os.path.getsize(os.path.join(root, f))
+                     for f in filenames])
+        files += len(filenames)
+    return size, files
+
+
+class LocalResources(object):
+    """Host-side copies of the content pushed to devices
+
+    Databases and attachment trees are extracted, and music tracks tagged,
+    into a working directory the first time they are needed. Resources that
+    are not shared are removed again as soon as they have been released,
+    whereas shared resources are kept so they can be pushed to any number of
+    devices until cleanup is called.
+
+    Each resource is named after the CRC and size of the zip members it is
+    created from, so a directory can safely be reused between runs.
+    """
+
+    def __init__(self, path=None, shared=False, logger=None, metrics=None):
+        self._path = path
+        self.shared = shared
+        self._logger = logger or default_logger()
+        self.metrics = metrics or Metrics(self._logger)
+
+    @property
+    def path(self):
+        if self._path is None:
+            self._path = tempfile.mkdtemp(prefix='b2gpopulate')
+        elif not os.path.isdir(self._path):
+            os.makedirs(self._path)
+        return self._path
+
+    def resource(self, name):
+        import pkg_resources
+        return pkg_resources.resource_filename(
+            __name__, os.path.sep.join(['resources', name]))
+
+    def database(self, data_type, count):
+        """Return a database holding count records of a data type
+
+        Preset counts are extracted from the prebuilt databases, and any
+        other count is generated from the nearest prebuilt one.
+        """
+        if count < 0:
+            raise InvalidCountError(data_type)
+        name, store, descending = DATABASES[data_type]
+        marker = template_marker(data_type, count)
+        archive_name = self.database_archive(name)
+        key = self._member_key(archive_name, '%s-%d.sqlite' % (name, marker))
+        db_name = '%s-%s-%d.sqlite' % (key, name, count)
+        if count == marker:
+            def extract(path):
+                member = '%s-%d.sqlite' % (name, count)
+                self._logger.debug('Extracting %s from %s' % (
+                    member, archive_name))
+                with open(path, 'wb') as db:
+                    db.write(self._open_archive(archive_name).read(member))
+            return self._create(db_name, extract, phase='extract')
+
+        def generate(path):
+            template = self.database(data_type, marker)
+            records = int(round(
+                float(count) * idb.count_records(template, store) / marker))
+            self._logger.debug('Generating %s with %d records from %s' % (
+                db_name, records, template))
+            start = time.time()
+            idb.generate(template, path, store, records, descending)
+            self._logger.debug('Generated %s in %.2fs' % (
+                db_name, time.time() - start))
+            self.release(template)
+        return self._create(db_name, generate, phase='generate')
+
+    def database_size(self, data_type, count):
+        """Return the estimated size of a database without creating it"""
+        name = DATABASES[data_type][0]
+        archive_name = self.database_archive(name)
+        if not os.path.exists(archive_name):
+            return 0
+        marker = template_marker(data_type, count)
+        size = self._open_archive(archive_name).getinfo(
+            '%s-%d.sqlite' % (name, marker)).file_size
+        return size * max(count, 1) / max(marker, 1)
+
+    def database_archive(self, name):
+        """Return the packaged store of the prebuilt databases of a type,
+        or the zip of them if it has no store"""
+        path = self.resource('%s.delta' % name)
+        if os.path.exists(path):
+            return path
+        return self.resource('%s.zip' % name)
+
+    def archive_usage(self, name, member=None):
+        """Return the number of files and bytes in a packaged zip, or in a
+        zip nested within it, without extracting them"""
+        path = self.resource(name)
+        if not os.path.exists(path):
+            return 0, 0
+        archive = ZipFile(path)
+        if member is not None:
+            archive = ZipFile(StringIO(archive.read(member)))
+        infos = [info for info in archive.infolist()
+                 if not info.filename.endswith('/')]
+        return len(infos), sum([info.file_size for info in infos])
+
+    def contact_pictures(self):
+        pictures_zip_name = self.resource('contactsPictures.zip')
+        return self._extract_all(pictures_zip_name, '%s-contactsPictures' % (
+            self._member_key(pictures_zip_name)))
+
+    def contact_pictures_archive(self):
+        """Return a zip of the contact pictures, which is never removed"""
+        return self.resource('contactsPictures.zip')
+
+    def message_attachments(self, marker):
+        all_attachments_zip_name = self.resource('smsAttachments.zip')
+        attachments_zip_name = 'smsAttachments-%d.zip' % marker
+
+        def extract(path):
+            self._logger.debug('Extracting %s from %s to %s' % (
+                attachments_zip_name, all_attachments_zip_name, path))
+            # the nested zip is small, so read it in memory rather than
+            # writing it to disk only to remove it again
+            ZipFile(StringIO(ZipFile(all_attachments_zip_name).read(
+                attachments_zip_name))).extractall(path)
+        return self._create('%s-%s' % (
+            self._member_key(all_attachments_zip_name, attachments_zip_name),
+            attachments_zip_name.rpartition('.')[0]), extract, phase='extract')
+
+    def message_attachments_archive(self, marker):
+        """Return the zip of the attachments shared by marker messages"""
+        all_attachments_zip_name = self.resource('smsAttachments.zip')
+        attachments_zip_name = 'smsAttachments-%d.zip' % marker
+
+        def extract(path):
+            self._logger.debug('Extracting %s from %s' % (
+                attachments_zip_name, all_attachments_zip_name))
+            with open(path, 'wb') as attachments_zip:
+                shutil.copyfileobj(ZipFile(all_attachments_zip_name).open(
+                    attachments_zip_name), attachments_zip)
+        return self._create('%s-%s' % (
+            self._member_key(all_attachments_zip_name, attachments_zip_name),
+            attachments_zip_name), extract, phase='extract')
+
+    def music(self, count, source='MUS_0001.mp3',
+              tracks_per_album=TRACKS_PER_ALBUM, albums=False):
+        """Return a directory of tagged copies of the source track
+
+        If albums is true the tracks of each album are placed in a directory
+        of their own.
+        """
+        music_file = self.resource(source)
+        names = track_names(os.path.basename(music_file), count)
+        key = '%08x' % (zlib.crc32(open(music_file, 'rb').read()) & 0xffffffff)
+
+        def generate(path):
+            os.mkdir(path)
+            with open(music_file, 'rb') as f:
+                data = f.read()
+            try:
+                copies = id3.tracks(data, count, tracks_per_album)
+                for name, track in zip(names, copies):
+                    with open(os.path.join(path, name), 'wb') as f:
+                        f.write(track)
+            except id3.UnsupportedTagError as e:
+                self._logger.debug('%s, tagging with mutagen instead' % e)
+                self._tag_with_mutagen(
+                    music_file, path, count, tracks_per_album)
+            if albums:
+                for i, filename in enumerate(names):
+                    directory = os.path.join(path, album_directory(
+                        i / tracks_per_album + 1))
+                    if not os.path.isdir(directory):
+                        os.mkdir(directory)
+                    os.rename(os.path.join(path, filename),
+                              os.path.join(directory, filename))
+        return self._create('%s-music-%s-%d-%d%s' % (
+            key, source, count, tracks_per_album, albums and '-albums' or ''),
+            generate, phase='tag')
+
+    def _tag_with_mutagen(self, music_file, path, count, tracks_per_album):
+        from mutagen.easyid3 import EasyID3
+        names = track_names(os.path.basename(music_file), count)
+        # copy the mp3 file into a temp location
+        with tempfile.NamedTemporaryFile() as local_copy:
+            self._logger.debug('Creating copy of %s at %s' % (
+                music_file, local_copy.name))
+            local_copy.write(open(music_file).read())
+            local_copy.flush()
+
+            mp3 = EasyID3(local_copy.name)
+            for i, name in enumerate(names):
+                # numbered as id3.tracks numbers them
+                album = i / tracks_per_album + 1
+                track = i % tracks_per_album + 1
+                mp3['title'] = 'Track %d' % track
+                mp3['artist'] = 'Artist %d' % album
+                mp3['album'] = 'Album %d' % album
+                mp3['tracknumber'] = str(track)
+                mp3.save()
+                shutil.copy(local_copy.name, os.path.join(path, name))
+
+    def variants(self, count, source, directory, files_per_directory=None):
+        """Return a tree of distinct copies of a picture or video
+
+        The copies are named as gaiatest's file manager names them and are
+        placed in directory, or spread over it and the directories that
+        follow it if files_per_directory is given.
+        """
+        media_file = self.resource(source)
+        local_filename = os.path.basename(media_file)
+        key = '%08x' % (zlib.crc32(open(media_file, 'rb').read()) & 0xffffffff)
+
+        def generate(path):
+            with open(media_file, 'rb') as f:
+                copies = variants.copies(local_filename, f.read(), count)
+            names = duplicate_names(local_filename, count)
+            ranges = shards(count, files_per_directory)
+            for shard, (first, last) in zip(
+                    shard_directories(directory, len(ranges)), ranges):
+                shard_dir = os.path.join(path, *shard.split('/'))
+                os.makedirs(shard_dir)
+                for name in names[first - 1:last]:
+                    with open(os.path.join(shard_dir, name), 'wb') as f:
+                        f.write(next(copies))
+        return self._create('%s-variants-%s-%d-%s-%d' % (
+            key, source, count, directory.replace('/', '-'),
+            files_per_directory or 0), generate, phase='variants')
+
+    def archive(self, directory):
+        """Return a zip archive containing the files in a directory, and in
+        any directories within it"""
+        def build(path):
+            self._logger.debug('Creating %s from %s' % (path, directory))
+            with ZipFile(path, 'w', ZIP_STORED) as archive:
+                for root, dirs, files in os.walk(directory):
+                    dirs.sort()
+                    for filename in sorted(files):
+                        local = os.path.join(root, filename)
+                        archive.write(local, os.path.relpath(
+                            local, directory).replace(os.path.sep, '/'))
+        return self._create('%s.zip' % os.path.basename(directory), build,
+                            phase='archive')
+
+    def compressed(self, source, name=None):
+        """Return a deflated zip archive of a file or of the files in a
+        directory, and in any directories within it
+
+        A single file is stored as name, which defaults to its own.
+        """
+        if os.path.isdir(source):
+            members = []
+            for root, dirs, files in os.walk(source):
+                dirs.sort()
+                for filename in sorted(files):
+                    local = os.path.join(root, filename)
+                    members.append((local, os.path.relpath(
+                        local, source).replace(os.path.sep, '/')))
+        else:
+            name = name or os.path.basename(source)
+            members = [(source, name)]
+
+        def build(path):
+            self._logger.debug('Compressing %s to %s' % (source, path))
+            with ZipFile(path, 'w', ZIP_DEFLATED) as archive:
+                for filename, arcname in members:
+                    archive.write(filename, arcname)
+        return self._create('%s%s.deflated.zip' % (
+            os.path.basename(source), name and '-%s' % name or ''), build,
+            phase='compress')
+
+    def relocated(self, image, destinations):
+        """Return a copy of a zip archive with its files moved
+
+        destinations maps names in the archive to absolute paths, which are
+        stored relative to the root directory.
+        """
+        with ZipFile(image) as source:
+            infos = dict((info.filename, info) for info in source.infolist())
+        key = '%08x' % (zlib.crc32(''.join(
+            ['%s:%s:%08x' % (name, destination, infos[name].CRC) for
+             name, destination in sorted(destinations.items())])) &
+            0xffffffff)
+
+        def build(path):
+            self._logger.debug('Relocating the files of %s in %s' % (
+                image, path))
+            with ZipFile(image) as source:
+                with ZipFile(path, 'w', ZIP_STORED) as archive:
+                    for name, destination in sorted(destinations.items()):
+                        archive.writestr(destination.lstrip(posixpath.sep),
+                                         source.read(name))
+        return self._create('%s-%s.zip' % (
+            os.path.splitext(os.path.basename(image))[0], key), build,
+            phase='relocate')
+
+    def prepare(self, call_count=None, contact_count=None,
+                message_count=None, music_count=None, event_count=None,
+                albums=False):
+        """Create everything needed to populate the given counts
+
+        Attachments are prepared as the archive that is unpacked on devices
+        with unzip. Devices without it extract what they need on demand.
+        Music is placed in a directory per album if albums is true.
+        """
+        for data_type, count in [
+                ('call', call_count),
+                ('contact', contact_count),
+                ('message', message_count),
+                ('event', event_count)]:
+            if count is not None:
+                self.database(data_type, count)
+        if message_count:
+            self.message_attachments_archive(
+                template_marker('message', message_count))
+        if music_count:
+            self.archive(self.music(music_count, albums=albums))
+
+    def release(self, path):
+        if not self.shared:
+            self._logger.debug('Removing %s' % path)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+
+    def cleanup(self):
+        if self._path is not None and os.path.exists(self._path):
+            self._logger.debug('Removing %s' % self._path)
+            shutil.rmtree(self._path)
+
+    def _member_key(self, zip_name, member=None):
+        """Return a key identifying the content of a zip member
+
+        Without a member the key identifies the content of the whole zip.
+        """
+        infos = self._open_archive(zip_name).infolist()
+        if member is not None:
+            infos = [info for info in infos if info.filename == member]
+            if not infos:
+                raise KeyError('There is no item named %r in %s' % (
+                    member, zip_name))
+        if len(infos) == 1:
+            return '%08x-%d' % (infos[0].CRC, infos[0].file_size)
+        return '%08x-%d' % (zlib.crc32(''.join(
+            ['%s:%08x' % (info.filename, info.CRC) for info in infos])) &
+            0xffffffff, sum([info.file_size for info in infos]))
+
+    def _open_archive(self, path):
+        if path.endswith('.delta'):
+            return delta.Store(path)
+        return ZipFile(path)
+
+    def _extract_all(self, zip_name, name):
+        def extract(path):
+            self._logger.debug('Extracting %s to %s' % (zip_name, path))
+            ZipFile(zip_name).extractall(path)
+        return self._create(name, extract, phase='extract')
+
+    def _create(self, name, build, phase):
+        path = os.path.join(self.path, name)
+        if os.path.exists(path):
+            self._used(path, created=False)
+        else:
+            # build next to the final location and rename into place so
+            # concurrent users never see a partial resource
+            temp = tempfile.mkdtemp(prefix='.', dir=self.path)
+            try:
+                with self.metrics.phase(phase) as record:
+                    build(os.path.join(temp, name))
+                    record['bytes'], record['items'] = disk_usage(
+                        os.path.join(temp, name))
+                try:
+                    os.rename(os.path.join(temp, name), path)
+                except OSError:
+                    if not os.path.exists(path):
+                        raise
+            finally:
+                shutil.rmtree(temp)
+            self._used(path, created=True)
+        return path
+
+    def _used(self, path, created):
+        pass
+
+
+class ResourceCache(LocalResources):
+    """Persistent cache of host-side resources
+
+    Resources are kept between runs in the cache directory. Whenever a new
+    resource is added or one is released, the least recently used ones are
+    evicted until the cache is no larger than max_size bytes. Resources that
+    have been used since they were last released are never evicted, so the
+    cache may be larger than max_size while they are needed.
+    """
+
+    def __init__(self, path, max_size=1024 * 1024 * 1024, logger=None):
+        LocalResources.__init__(self, path, shared=True, logger=logger)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._in_use = set()
+        self._evict()
+
+    def release(self, path):
+        self._in_use.discard(path)
+        self._evict()
+
+    def cleanup(self):
+        pass
+
+    def entries(self):
+        """Return (path, size, last used) for each entry, oldest first"""
+        entries = []
+        for name in os.listdir(self.path):
+            if name.startswith('.'):
+                continue
+            path = os.path.join(self.path, name)
+            size = os.path.getsize(path)
+            if os.path.isdir(path):
+                for root, dirs, files in os.walk(path):
+                    size += sum([os.path.getsize(os.path.join(root, f))
+                                 for f in files])
+            entries.append((path, size, os.path.getmtime(path)))
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def stats(self):
+        entries = self.entries()
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(entries),
+                'size': sum([entry[1] for entry in entries]),
+                'max_size': self.max_size}
+
+    def report(self):
+        stats = self.stats()
+        stats['path'] = self.path
+        self._logger.info(
+            'Cache %(path)s: %(hits)d hits, %(misses)d misses, %(evictions)d '
+            'evictions, %(entries)d entries using %(size)d of %(max_size)d '
+            'bytes' % stats)
+
+    def _used(self, path, created):
+        os.utime(path, None)
+        self._in_use.add(path)
+        if created:
+            self.misses += 1
+            self._evict()
+        else:
+            self._logger.debug('Using cached %s' % path)
+            self.hits += 1
+
+    def _evict(self):
+        entries = self.entries()
+        size = sum([entry[1] for entry in entries])
+        for path, entry_size, last_used in entries:
+            if size <= self.max_size:
+                break
+            if path in self._in_use:
+                continue
+            self._logger.debug('Evicting %s from cache' % path)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+            size -= entry_size
+            self.evictions += 1
 
 
 class B2GPopulate(object):
 
     STORAGE_PATH = '/data/local/storage'
+    # older adb daemons truncate longer shell command lines
+    MAX_COMMAND_LENGTH = 1024
+    # smaller files are pushed as they are even when compressing
+    MIN_COMPRESS_SIZE = 64 * 1024
+    MAX_COMPRESS_RATIO = 0.9
+    SNAPSHOT_VERSION = 1
+    # media counts are polled at increasing intervals while B2G indexes
+    MIN_POLL_INTERVAL = 0.1
+    MAX_POLL_INTERVAL = 2
 
-    handler = mozlog.StreamHandler()
-    handler.setFormatter(mozlog.MozFormatter(include_timestamp=True))
-    logger = mozlog.getLogger('B2GPopulate', handler)
-
-    def __init__(self, marionette, start_timeout=60, device_serial=None):
+    def __init__(self, marionette, start_timeout=60, device_serial=None,
+                 jobs=1, resources=None, incremental=False, device=None,
+                 compress=False, journal=None, files_per_directory=None,
+                 index_timeout=None, unique_media=False):
+        from gaiatest import GaiaData
+        from gaiatest import GaiaDevice
         self.marionette = marionette
         self.data_layer = GaiaData(self.marionette)
-        dm = mozdevice.DeviceManagerADB(deviceSerial=device_serial)
-        self.device = GaiaDevice(self.marionette, manager=dm)
+        if device is None:
+            import mozdevice
+            dm = mozdevice.DeviceManagerADB(deviceSerial=device_serial)
+            device = GaiaDevice(self.marionette, manager=dm)
+        self.device = device
 
-        self._logger = structured.get_default_logger(component='b2gpopulate')
-        if not self._logger:
-            self._logger = mozlog.getLogger('b2gpopulate')
-        self.start_timeout = start_timeout
+        self._logger = default_logger()
+        self._unzip_available = None
+        self._volumes = None
+        self._checksum_command = None
+        self._webapps = None
+        self.reset(start_timeout=start_timeout, jobs=jobs, resources=resources,
+                   incremental=incremental, compress=compress, journal=journal,
+                   files_per_directory=files_per_directory,
+                   index_timeout=index_timeout, unique_media=unique_media)
 
         if self.device.is_android_build:
             self.idb_dir = 'idb'
@@ -114,253 +947,861 @@ class B2GPopulate(object):
                     self.idb_dir = candidate
                     break
 
+    def reset(self, start_timeout=60, jobs=1, resources=None,
+              incremental=False, compress=False, journal=None,
+              files_per_directory=None, index_timeout=None,
+              unique_media=False):
+        """Set the options of the next population
+
+        This lets the same instance populate the device again, keeping the
+        Marionette session, the device manager and what was discovered
+        about the device, such as its IndexedDB directory and app local
+        ids. Whatever was learnt about the content of the device is
+        forgotten, as it may have changed in between.
+        """
+        self.start_timeout = start_timeout
+        self.jobs = jobs
+        self.resources = resources or LocalResources(logger=self._logger)
+        self.metrics = self.resources.metrics
+        self.incremental = incremental
+        self.compress = compress
+        self.journal = journal
+        self.files_per_directory = files_per_directory
+        self.index_timeout = index_timeout
+        self.unique_media = unique_media
+        self.index_latencies = {}
+        self.bytes_sent = 0
+        self.bytes_skipped = 0
+        self._checksums = {}
+        self._checksummed = set()
+        self._local_checksums = {}
+        self._expected_records = {}
+        self._media_pushed = {}
+
     def populate(self, call_count=None, contact_count=None, message_count=None,
                  music_count=None, picture_count=None, video_count=None,
                  event_count=None):
 
-        restart = any([i is not None for i in [
-            call_count, contact_count, event_count, message_count]])
+        plan = create_plan(
+            self, self.resources, start_timeout=self.start_timeout,
+            jobs=self.jobs, call_count=call_count,
+            contact_count=contact_count, message_count=message_count,
+            music_count=music_count, picture_count=picture_count,
+            video_count=video_count, event_count=event_count)
+        try:
+            plan.run()
+        finally:
+            if not self.resources.shared:
+                self.resources.cleanup()
+        if self.journal is not None:
+            self.journal.remove()
 
-        if restart:
-            self._logger.debug('Stopping B2G')
-            self.device.stop_b2g()
+        self.metrics.report()
+        if self.incremental:
+            self._logger.info(
+                'Sent %d bytes, skipped %d bytes already on the device' % (
+                    self.bytes_sent, self.bytes_skipped))
 
-        if call_count is not None:
-            self.populate_calls(call_count, restart=False)
+    def snapshot(self, path):
+        """Capture the databases and media on the device in a zip image
 
-        if contact_count is not None:
-            self.populate_contacts(contact_count, restart=False)
+        Databases are stored under databases/ by type and media under
+        media/ by volume, so that the image can be restored to devices with
+        different app local ids or IndexedDB directories. The zip comment
+        holds a manifest of what was captured.
+        """
+        self._logger.info('Taking a snapshot of the device to %s' % path)
+        manifest = {'version': self.SNAPSHOT_VERSION,
+                    'databases': [],
+                    'media': {}}
+        temp = tempfile.mkdtemp(dir=self.resources.path)
+        try:
+            # media is listed through B2G, so pull it before stopping B2G
+            scheduler = TransferScheduler(self._logger, self.jobs)
+            for file_type in ['music', 'picture', 'video']:
+                files = getattr(self.data_layer, '%s_files' % file_type) or []
+                manifest['media'][file_type] = len(files)
+                for filename in files:
+                    local = os.path.join(temp, 'media', *filename.strip(
+                        posixpath.sep).split(posixpath.sep))
+                    self._pull(scheduler, self.media_path(filename)[1], local)
+            self.run_transfers(scheduler, phase='pull', action='Pulled')
 
-        if event_count is not None:
-            self.populate_events(event_count, restart=False)
+            # stop B2G so that the databases are not changing as they are
+            # pulled
+            self.stop_b2g()
+            for data_type in ['call', 'contact', 'event', 'message']:
+                destination = self.database_destination(data_type)
+                if not self.device.manager.fileExists(destination):
+                    continue
+                manifest['databases'].append(data_type)
+                local = os.path.join(temp, 'databases', data_type)
+                self._pull(scheduler, destination, '%s.sqlite' % local)
+                files = '%s.files' % destination.rpartition('.')[0]
+                if self.device.manager.dirExists(files):
+                    scheduler.add(files, self.device.manager.getDirectory,
+                                  (files, '%s.files' % local))
+            try:
+                self.run_transfers(scheduler, phase='pull', action='Pulled')
+            finally:
+                self.start_b2g()
 
-        if message_count is not None:
-            self.populate_messages(message_count, restart=False)
+            with self.metrics.phase('snapshot') as record:
+                with ZipFile(path, 'w', ZIP_STORED) as image:
+                    for root, dirs, files in os.walk(temp):
+                        for filename in sorted(files):
+                            local = os.path.join(root, filename)
+                            image.write(local, os.path.relpath(
+                                local, temp).replace(os.path.sep,
+                                                     posixpath.sep))
+                    image.comment = json.dumps(manifest)
+                record['bytes'] = os.path.getsize(path)
+        finally:
+            shutil.rmtree(temp)
+            if not self.resources.shared:
+                self.resources.cleanup()
+        self._logger.info('Captured %s and %s' % (
+            ', '.join(['%d %s files' % (count, file_type) for
+                       file_type, count in sorted(manifest['media'].items())]),
+            ', '.join(['the %s database' % t for t in manifest['databases']])
+            or 'no databases'))
 
-        if restart:
+    def restore(self, path):
+        """Apply a snapshot to the device, stopping B2G only once"""
+        self._logger.info('Restoring %s to the device' % path)
+        with ZipFile(path) as image:
+            try:
+                manifest = json.loads(image.comment)
+            except ValueError:
+                manifest = {}
+            if not manifest.get('version') == self.SNAPSHOT_VERSION:
+                raise B2GPopulateError(
+                    '%s is not a snapshot taken by this version' % path)
+            destinations = dict(
+                (name, self.snapshot_destination(name)) for name in
+                image.namelist() if not name.endswith(posixpath.sep))
+
+        for file_type in sorted(manifest['media']):
+            self.remove_media(file_type)
+        self.stop_b2g()
+        # replace the databases along with their journals and attachments
+        stems = ['%s*' % self.database_destination(data_type).rpartition(
+            '.')[0] for data_type in manifest['databases']]
+        for batch in self.command_batches(['rm', '-r'], stems):
+            # a database that is not on the device fails to match
+            self.device.manager.shell(['rm', '-r'] + batch, StringIO())
+        try:
+            if self.is_unzip_available:
+                archive = self.resources.relocated(path, destinations)
+                self.push_archive(archive, posixpath.sep,
+                                  staging=self.device.manager.getTempDir())
+                self.resources.release(archive)
+            else:
+                temp = tempfile.mkdtemp(dir=self.resources.path)
+                try:
+                    with ZipFile(path) as image:
+                        image.extractall(temp)
+                    # each database, directory of attachments and volume of
+                    # media is pushed as a whole, alongside the others
+                    scheduler = TransferScheduler(self._logger, self.jobs)
+                    pushed = set()
+                    for name, destination in sorted(destinations.items()):
+                        parts = name.split(posixpath.sep, 2)
+                        if len(parts) < 3:
+                            scheduler.push_file(
+                                self.device.manager, os.path.join(
+                                    temp, *parts), destination)
+                        elif tuple(parts[:2]) not in pushed:
+                            pushed.add(tuple(parts[:2]))
+                            scheduler.push_dir(
+                                self.device.manager,
+                                os.path.join(temp, *parts[:2]),
+                                destination[:-len(parts[2]) - 1])
+                    self.bytes_sent += self.run_transfers(scheduler)['bytes']
+                finally:
+                    shutil.rmtree(temp)
+        finally:
+            self._checksums.clear()
+            self._checksummed.clear()
             self.start_b2g()
+            if not self.resources.shared:
+                self.resources.cleanup()
+
+        for file_type, count in sorted(manifest['media'].items()):
+            actual = self.media_count(file_type)
+            if not actual == count:
+                raise IncorrectCountError(
+                    '%s files' % file_type, count, actual)
+        self.metrics.report()
 
+    def snapshot_destination(self, name):
+        """Return where a file in a snapshot belongs on the device"""
+        parts = name.split(posixpath.sep, 2)
+        if parts[0] == 'media':
+            return self.media_path(posixpath.sep.join(parts[1:]))[1]
+        data_type, extension = parts[1].split('.', 1)
+        destination = self.database_destination(data_type)
+        if extension == 'sqlite':
+            return destination
+        return posixpath.join('%s.files' % destination.rpartition('.')[0],
+                              parts[2])
+
+    def _pull(self, scheduler, remote, local):
+        if not os.path.isdir(os.path.dirname(local)):
+            os.makedirs(os.path.dirname(local))
+        scheduler.add(remote, self.device.manager.getFile, (remote, local))
+
+    def fetch_target_checksums(self, call_count=None, contact_count=None,
+                               message_count=None, music_count=None,
+                               picture_count=None, video_count=None,
+                               event_count=None):
+        """Fetch the checksums of every target directory in one go"""
+        directories = set()
+        for data_type, count in [('call', call_count),
+                                 ('contact', contact_count),
+                                 ('event', event_count),
+                                 ('message', message_count)]:
+            if count is not None:
+                directories.update([
+                    posixpath.dirname(remote) for local, remote in
+                    self.database_transfers(data_type, count)])
+        root = self.device.manager.deviceRoot
         if music_count is not None:
-            self.populate_music(music_count)
+            directories.add(root)
+            if self.files_per_directory:
+                # albums of populate_music's default length
+                directories.update([
+                    posixpath.join(root, album_directory(album)) for
+                    album in range(1, (music_count + TRACKS_PER_ALBUM - 1) /
+                                   TRACKS_PER_ALBUM + 1)])
+        for file_type, count in [('picture', picture_count),
+                                 ('video', video_count)]:
+            if count is not None:
+                directories.update([
+                    directory for directory, first, last in
+                    self.copy_shards(posixpath.join(root, media_directory(
+                        file_type, self.files_per_directory)), count)])
+        self.fetch_checksums(directories)
+
+    def databases_populated(self, call_count=None, contact_count=None,
+                            message_count=None, event_count=None):
+        """Check whether B2G can be left running as no database changes"""
+        if not self.incremental or not self.checksum_command:
+            return False
+        transfers = []
+        for data_type, count in [('call', call_count),
+                                 ('contact', contact_count),
+                                 ('event', event_count),
+                                 ('message', message_count)]:
+            if count is not None:
+                transfers.extend(self.database_transfers(data_type, count))
+        return all([self.is_up_to_date(l, r) for l, r in transfers])
+
+    def database_destination(self, data_type):
+        """Return the path of a database on the device"""
+        if data_type in DATABASE_APPS:
+            key = DATABASE_APPS[data_type]
+            filename = {'call': '2584670174dsitanleecreR.sqlite',
+                        'event': '125582036br2agd-nceal.sqlite'}[data_type]
+            path = posixpath.join(self.STORAGE_PATH, 'default',
+                                  '%s+f+app+++%s' % (self.app_local_id(key),
+                                                     key),
+                                  self.idb_dir)
+        else:
+            path = posixpath.join(self.STORAGE_PATH, 'permanent', 'chrome',
+                                  self.idb_dir)
+            filename = {'contact': '3406066227csotncta.sqlite',
+                        'message': '226660312ssm.sqlite'}[data_type]
+        return posixpath.join(path, filename)
 
-        if picture_count is not None:
-            self.populate_pictures(picture_count)
+    def database_transfers(self, data_type, count, include_pictures=True):
+        """Return the (local, remote) files needed to populate a database"""
+        destination = self.database_destination(data_type)
+        transfers = [(self.resources.database(data_type, count), destination)]
+        files = '%s.files' % destination.rpartition('.')[0]
+        if data_type == 'contact' and count > 0 and include_pictures:
+            transfers.extend(self.dir_transfers(
+                self.resources.contact_pictures(), files))
+        if data_type == 'message' and count > 0:
+            # generated messages share the attachments of their template
+            transfers.extend(self.dir_transfers(
+                self.resources.message_attachments(
+                    template_marker('message', count)), files))
+        return transfers
 
-        if video_count is not None:
-            self.populate_videos(video_count)
+    def dir_transfers(self, local_dir, remote_dir):
+        transfers = []
+        for root, dirs, files in os.walk(local_dir):
+            relative = os.path.relpath(root, local_dir)
+            for filename in sorted(files):
+                transfers.append((
+                    os.path.join(root, filename),
+                    posixpath.normpath(posixpath.join(
+                        remote_dir,
+                        relative.replace(os.path.sep, posixpath.sep),
+                        filename))))
+        return transfers
+
+    def app_local_id(self, key):
+        if self._webapps is None:
+            with self.metrics.phase('pull_webapps') as record:
+                webapps = self.device.manager.pullFile(
+                    '/data/local/webapps/webapps.json')
+                record['bytes'] = len(webapps)
+            self._webapps = json.loads(webapps)
+        return self._webapps[key]['localId']
 
     def populate_calls(self, count, restart=True):
-        # only allow preset db values for calls
-        db_counts = [WORKLOADS[k]['call'] for k in WORKLOADS.keys()]
-        if count not in db_counts:
-            raise InvalidCountError('call')
         self._logger.info('Populating %d calls' % count)
-        db_counts.sort(reverse=True)
-        for marker in db_counts:
-            if count >= marker:
-                key = 'communications.gaiamobile.org'
-                local_id = json.loads(self.device.manager.pullFile(
-                    '/data/local/webapps/webapps.json'))[key]['localId']
-                db_zip_name = pkg_resources.resource_filename(
-                    __name__, os.path.sep.join(['resources', 'dialerDb.zip']))
-                db_name = 'dialerDb-%d.sqlite' % marker
-                self._logger.debug('Extracting %s from %s' % (
-                    db_name, db_zip_name))
-                db = ZipFile(db_zip_name).extract(db_name)
-                if restart:
-                    self.device.stop_b2g()
-                destination = posixpath.join(self.STORAGE_PATH, 'default',
-                                             '%s+f+app+++%s' % (local_id, key),
-                                             self.idb_dir,
-                                             '2584670174dsitanleecreR.sqlite')
-                self._logger.debug('Pushing %s to %s' % (db, destination))
-                self.device.manager.pushFile(db, destination)
-                self._logger.debug('Removing %s' % db)
-                os.remove(db)
-                if restart:
-                    self.start_b2g()
-                break
+        self._populate_database('call', count, restart)
 
     def populate_contacts(self, count, restart=True, include_pictures=True):
-        # only allow preset db values for contacts
-        db_counts = [WORKLOADS[k]['contact'] for k in WORKLOADS.keys()]
-        if count not in db_counts:
-            raise InvalidCountError('contact')
+        self._logger.info('Populating %d contacts' % count)
+        db = self.resources.database('contact', count)
+        self._expect_records('contact', db)
+        if self.incremental and self.is_populated(self.database_transfers(
+                'contact', count, include_pictures)):
+            self._logger.info('Contacts are already on the device')
+            return
         path = posixpath.join(self.STORAGE_PATH, 'permanent', 'chrome', self.idb_dir)
         self.device.file_manager.remove(posixpath.join(path, '*csotncta*'))
-        self._logger.info('Populating %d contacts' % count)
-        db_counts.sort(reverse=True)
-        for marker in db_counts:
-            if count >= marker:
-                db_zip_name = pkg_resources.resource_filename(
-                    __name__, os.path.sep.join(['resources',
-                                                'contactsDb.zip']))
-                db_name = 'contactsDb-%d.sqlite' % marker
-                self._logger.debug('Extracting %s from %s' % (
-                    db_name, db_zip_name))
-                db = ZipFile(db_zip_name).extract(db_name)
-                if restart:
-                    self.device.stop_b2g()
-                destination = posixpath.join(path, '3406066227csotncta.sqlite')
-                self._logger.debug('Pushing %s to %s' % (db, destination))
-                self.device.manager.pushFile(db, destination)
-                self._logger.debug('Removing %s' % db)
-                os.remove(db)
-                if marker > 0 and include_pictures:
-                    self._logger.debug('Adding contact pictures')
-                    pictures_zip_name = pkg_resources.resource_filename(
-                        __name__, os.path.sep.join(
-                            ['resources', 'contactsPictures.zip']))
-                    temp = tempfile.mkdtemp()
-                    self._logger.debug('Extracting %s to %s' % (
-                        pictures_zip_name, temp))
-                    ZipFile(pictures_zip_name).extractall(temp)
-                    destination = posixpath.join(path, '3406066227csotncta.files')
-                    self._logger.debug('Pushing %s to %s' % (temp, destination))
-                    self.device.manager.pushDir(temp, destination)
-                    self._logger.debug('Removing %s' % temp)
-                    shutil.rmtree(temp)
-                if restart:
-                    self.start_b2g()
-                break
+        self._forget_checksums(posixpath.join(path, '3406066227csotncta'))
+        destination = self.database_destination('contact')
+        if restart:
+            self.stop_b2g()
+        self._logger.debug('Pushing %s to %s' % (db, destination))
+        self.push_file(db, destination)
+        self.resources.release(db)
+        if count > 0 and include_pictures:
+            self._logger.debug('Adding contact pictures')
+            destination = posixpath.join(path, '3406066227csotncta.files')
+            # the pictures were removed along with the database, so there
+            # is nothing for an incremental push to skip
+            if self.is_unzip_available:
+                archive = self.resources.contact_pictures_archive()
+                self.push_archive(archive, destination,
+                                  expected=ZipFile(archive).namelist())
+            else:
+                pictures = self.resources.contact_pictures()
+                self._logger.debug('Pushing %s to %s' % (
+                    pictures, destination))
+                self.push_dir(pictures, destination)
+                self.resources.release(pictures)
+        if restart:
+            self.start_b2g()
 
     def populate_events(self, count, restart=True):
-        # only allow preset db values for events
-        db_counts = [WORKLOADS[k]['event'] for k in WORKLOADS.keys()]
-        if count not in db_counts:
-            raise InvalidCountError('event')
         self._logger.info('Populating %d events' % count)
-        db_counts.sort(reverse=True)
-        for marker in db_counts:
-            if count >= marker:
-                key = 'calendar.gaiamobile.org'
-                local_id = json.loads(self.device.manager.pullFile(
-                    '/data/local/webapps/webapps.json'))[key]['localId']
-                db_zip_name = pkg_resources.resource_filename(
-                    __name__, os.path.sep.join(['resources',
-                                                'calendarDb.zip']))
-                db_name = 'calendarDb-%d.sqlite' % marker
-                self._logger.debug('Extracting %s from %s' % (
-                    db_name, db_zip_name))
-                db = ZipFile(db_zip_name).extract(db_name)
-                if restart:
-                    self.device.stop_b2g()
-                destination = posixpath.join(self.STORAGE_PATH, 'default',
-                                             '%s+f+app+++%s' % (local_id, key),
-                                             self.idb_dir,
-                                             '125582036br2agd-nceal.sqlite')
-                self._logger.debug('Pushing %s to %s' % (db, destination))
-                self.device.manager.pushFile(db, destination)
-                self._logger.debug('Removing %s' % db)
-                os.remove(db)
-                if restart:
-                    self.start_b2g()
-                break
+        self._populate_database('event', count, restart)
 
     def populate_messages(self, count, restart=True):
-        # only allow preset db values for messages
-        db_counts = [WORKLOADS[k]['message'] for k in WORKLOADS.keys()]
-        if count not in db_counts:
-            raise InvalidCountError('message')
         self._logger.info('Populating %d messages' % count)
-        db_counts.sort(reverse=True)
-        for marker in db_counts:
-            if count >= marker:
-                db_zip_name = pkg_resources.resource_filename(
-                    __name__, os.path.sep.join(['resources', 'smsDb.zip']))
-                db_name = 'smsDb-%d.sqlite' % marker
-                self._logger.debug('Extracting %s from %s' % (
-                    db_name, db_zip_name))
-                db = ZipFile(db_zip_name).extract(db_name)
-                if restart:
-                    self.device.stop_b2g()
-                path = posixpath.join(self.STORAGE_PATH, 'permanent', 'chrome', self.idb_dir)
-                destination = posixpath.join(path, '226660312ssm.sqlite')
-                self._logger.debug('Pushing %s to %s' % (db, destination))
-                self.device.manager.pushFile(db, destination)
-                os.remove(db)
-                if marker > 0:
-                    self._logger.debug('Adding message attachments')
-                    all_attachments_zip_name = pkg_resources.resource_filename(
-                        __name__, os.path.sep.join(
-                            ['resources', 'smsAttachments.zip']))
-                    attachments_zip_name = 'smsAttachments-%d.zip' % marker
-                    self._logger.debug('Extracting %s from %s' % (
-                        attachments_zip_name, all_attachments_zip_name))
-                    attachments_zip = ZipFile(
-                        all_attachments_zip_name).extract(attachments_zip_name)
-                    temp = tempfile.mkdtemp()
-                    self._logger.debug('Extracting %s to %s' % (
-                        attachments_zip, temp))
-                    ZipFile(attachments_zip).extractall(temp)
-                    destination = posixpath.join(path, '226660312ssm.files')
-                    self._logger.debug('Pushing %s to %s' % (temp, destination))
-                    self.device.manager.pushDir(temp, destination)
-                    self._logger.debug('Removing %s' % temp)
-                    shutil.rmtree(temp)
-                    self._logger.debug('Removing %s' % attachments_zip)
-                    os.remove(attachments_zip)
-                if restart:
-                    self.start_b2g()
+        self._populate_database('message', count, restart)
+
+    def _populate_database(self, data_type, count, restart):
+        db = self.resources.database(data_type, count)
+        self._expect_records(data_type, db)
+        if self.incremental and self.is_populated(
+                self.database_transfers(data_type, count)):
+            self._logger.info('The %s database is already on the device' % (
+                data_type))
+            return
+        destination = self.database_destination(data_type)
+        if restart:
+            self.stop_b2g()
+        self._logger.debug('Pushing %s to %s' % (db, destination))
+        self.push_file(db, destination)
+        self.resources.release(db)
+        if data_type == 'message' and count > 0:
+            self._logger.debug('Adding message attachments')
+            marker = template_marker('message', count)
+            destination = '%s.files' % destination.rpartition('.')[0]
+            # an incremental push needs the files to compare them
+            if self.is_unzip_available and not self.incremental:
+                archive = self.resources.message_attachments_archive(marker)
+                self.push_archive(archive, destination,
+                                  expected=ZipFile(archive).namelist())
+                self.resources.release(archive)
+            else:
+                attachments = self.resources.message_attachments(marker)
+                self._logger.debug('Pushing %s to %s' % (
+                    attachments, destination))
+                self.push_dir(attachments, destination)
+                self.resources.release(attachments)
+        if restart:
+            self.start_b2g()
+
+    def _expect_records(self, data_type, db):
+        # remember what to look for once B2G has loaded the database
+        self._expected_records[data_type] = (
+            idb.database_name(db),
+            idb.count_records(db, DATABASES[data_type][1]))
+
+    def verify_counts(self, call_count=None, contact_count=None,
+                      message_count=None, music_count=None,
+                      picture_count=None, video_count=None,
+                      event_count=None):
+        """Check the counts on the device with a single Marionette script
+
+        Databases must hold as many records as those that were pushed, and
+        each media type the number of files requested. All mismatches are
+        raised together.
+        """
+        databases = []
+        expected = {}
+        for data_type, count in [('call', call_count),
+                                 ('contact', contact_count),
+                                 ('event', event_count),
+                                 ('message', message_count)]:
+            if count is None:
+                continue
+            if data_type not in self._expected_records:
+                # the database was pushed by an earlier run
+                self._expect_records(
+                    data_type, self.resources.database(data_type, count))
+            name, expected[data_type] = self._expected_records[data_type]
+            database = {'type': data_type,
+                        'name': name,
+                        'store': DATABASES[data_type][1]}
+            if data_type in DATABASE_APPS:
+                database['origin'] = 'app://%s' % DATABASE_APPS[data_type]
+                database['appId'] = self.app_local_id(
+                    DATABASE_APPS[data_type])
+            databases.append(database)
+        media = []
+        for file_type, count in [('music', music_count),
+                                 ('picture', picture_count),
+                                 ('video', video_count)]:
+            if count is not None:
+                expected[file_type] = count
+                media.append([file_type, MEDIA_STORAGES[file_type]])
+        if not expected:
+            return
+
+        start = time.time()
+        counts = self._count(databases, media)
+        duration = time.time() - start
+        self.metrics.add('verify', duration, items=len(expected))
+
+        mismatches = [
+            (data_type in MEDIA_STORAGES and '%s files' % data_type or
+             '%ss' % data_type, expected[data_type], counts.get(data_type))
+            for data_type in sorted(expected)
+            if not counts.get(data_type) == expected[data_type]]
+        if mismatches:
+            raise IncorrectCountError(mismatches)
+        self._logger.info('Verified %d counts in %.2fs' % (
+            len(expected), duration))
+
+    def wait_for_media(self, music_count=None, picture_count=None,
+                       video_count=None, timeout=DEFAULT_INDEX_TIMEOUT):
+        """Wait until B2G reports the expected number of each media type
+
+        B2G does not signal when it has finished scanning new media, so the
+        counts of every type still pending are polled in a single script,
+        at first every MIN_POLL_INTERVAL seconds and then backing off up to
+        MAX_POLL_INTERVAL. The time from each type being pushed until it is
+        reported in full is logged, recorded as an index phase and returned
+        by type. Raises IncorrectCountError if the counts are still wrong
+        once timeout seconds have passed.
+        """
+        expected = dict([(file_type, count) for file_type, count in [
+            ('music', music_count), ('picture', picture_count),
+            ('video', video_count)] if count is not None])
+        start = time.time()
+        interval = self.MIN_POLL_INTERVAL
+        latencies = {}
+        while True:
+            pending = [t for t in sorted(expected) if t not in latencies]
+            counts = self._count([], [[file_type, MEDIA_STORAGES[file_type]]
+                                      for file_type in pending])
+            now = time.time()
+            for file_type in pending:
+                if counts.get(file_type) != expected[file_type]:
+                    continue
+                latencies[file_type] = now - self._media_pushed.get(
+                    file_type, start)
+                self.metrics.add('index_%s' % file_type, latencies[file_type],
+                                 items=expected[file_type])
+                self._logger.info('%d %s files were indexed %.2fs after '
+                                  'being pushed' % (
+                                      expected[file_type], file_type,
+                                      latencies[file_type]))
+            if len(latencies) == len(expected):
                 break
+            if now - start > timeout:
+                raise IncorrectCountError([
+                    ('%s files' % file_type, expected[file_type],
+                     counts.get(file_type)) for file_type in pending
+                    if file_type not in latencies])
+            time.sleep(min(interval, max(0, start + timeout - now)))
+            interval = min(interval * 2, self.MAX_POLL_INTERVAL)
+        self.index_latencies.update(latencies)
+        return latencies
+
+    def _count(self, databases, media):
+        """Run the count script, which needs the chrome context"""
+        self.marionette.set_context(self.marionette.CONTEXT_CHROME)
+        try:
+            return self.marionette.execute_async_script(
+                COUNT_SCRIPT, script_args=[databases, media])
+        finally:
+            self.marionette.set_context(self.marionette.CONTEXT_CONTENT)
 
     def populate_music(self, count, source='MUS_0001.mp3',
-                       tracks_per_album=10):
+                       tracks_per_album=TRACKS_PER_ALBUM, batch=True):
+        """Populate tagged copies of a track
+
+        When sharding the tracks of each album are placed in a directory of
+        their own, rather than all of them in the root of the device.
+        """
+        destination = self.device.manager.deviceRoot
+        if count > 0:
+            tracks = self.resources.music(
+                count, source, tracks_per_album,
+                albums=bool(self.files_per_directory))
+            if self.incremental and self.media_count('music') == count and \
+                    self.is_populated(self.dir_transfers(tracks, destination)):
+                self._logger.info('%d music files are already on the '
+                                  'device' % count)
+                return
         self.remove_media('music')
 
         import math
-        from mutagen.easyid3 import EasyID3
-        music_file = pkg_resources.resource_filename(
-            __name__, os.path.sep.join(['resources', source]))
-        local_filename = music_file.rpartition(os.path.sep)[-1]
-
-        # copy the mp3 file into a temp location
-        with tempfile.NamedTemporaryFile() as local_copy:
-            self._logger.debug('Creating copy of %s at %s' % (
-                music_file, local_copy.name))
-            local_copy.write(open(music_file).read())
-            music_file = local_copy.name
+        album_count = math.ceil(float(count) / tracks_per_album)
+        self._logger.info('Populating %d music files (%d album%s)' % (
+            count, album_count, '' if album_count == 1 else 's'))
+        if count == 0:
+            return
 
-            mp3 = EasyID3(music_file)
-            album_count = math.ceil(float(count) / tracks_per_album)
-            self._logger.info('Populating %d music files (%d album%s)' % (
-                count, album_count, '' if album_count == 1 else 's'))
-
-            for i in range(1, count + 1):
-                album = math.ceil(float(i) / float(tracks_per_album))
-                track = i - ((album - 1) * tracks_per_album)
-                mp3['title'] = 'Track %d' % track
-                mp3['artist'] = 'Artist %d' % album
-                mp3['album'] = 'Album %d' % album
-                mp3['tracknumber'] = str(track)
-                mp3.save()
-                remote_filename = '_%s.'.join(
-                    iter(local_filename.split('.'))) % i
-                remote_destination = posixpath.join(
-                    self.device.manager.deviceRoot, remote_filename)
-                self._logger.debug('Pushing %s to %s' % (
-                    music_file, remote_destination))
-                self.device.manager.pushFile(music_file, remote_destination)
+        self.push_tree(tracks, destination, batch)
+        self._media_pushed['music'] = time.time()
+        self.resources.release(tracks)
 
     def populate_pictures(self, count, source='IMG_0001.jpg',
-                          destination='DCIM/100MZLLA'):
-        self.populate_files('picture', source, count, destination)
+                          destination=None):
+        self.populate_files('picture', source, count, destination or
+                            media_directory('picture',
+                                            self.files_per_directory))
 
     def populate_videos(self, count, source='VID_0001.3gp',
-                        destination='DCIM/100MZLLA'):
-        self.populate_files('video', source, count, destination)
+                        destination=None):
+        self.populate_files('video', source, count, destination or
+                            media_directory('video',
+                                            self.files_per_directory))
 
     def populate_files(self, file_type, source, count, destination=''):
+        """Populate copies of a picture or video
+
+        The file is pushed once and copied on the device, unless each copy
+        is to be distinct, in which case copies with metadata of their own
+        are generated on the host and pushed.
+        """
         destination = posixpath.join(self.device.manager.deviceRoot, destination)
+        parent, name = posixpath.split(destination)
+        if count > 0:
+            source_file = self.resources.resource(source)
+            if self.unique_media:
+                tree = self.resources.variants(
+                    count, source, name, self.files_per_directory)
+                transfers = self.dir_transfers(tree, parent)
+            else:
+                transfers = self.copy_transfers(
+                    source_file, destination, count)
+            if self.incremental and self.media_count(file_type) == count and \
+                    self.is_populated(transfers):
+                self._logger.info('%d %s files are already on the '
+                                  'device' % (count, file_type))
+                return
         self.remove_media(file_type)
 
         self._logger.info('Populating %d %s files' % (count, file_type))
-        if count > 0:
-            source_file = pkg_resources.resource_filename(
-                __name__, os.path.sep.join(['resources', source]))
+        if count > 0 and self.unique_media:
+            self._logger.debug('Pushing %d variants of %s to %s' % (
+                count, source_file, destination))
+            self.push_tree(tree, parent)
+            self._media_pushed[file_type] = time.time()
+            self.resources.release(tree)
+        elif count > 0:
             self._logger.debug('Pushing %d copies of %s to %s' % (
                 count, source_file, destination))
-            self.device.file_manager.push_file(source_file, destination, count)
+            if count > 1:
+                self.duplicate_file(source_file, destination, count)
+            else:
+                with self.metrics.phase(
+                        'push', os.path.getsize(source_file), count):
+                    self.device.file_manager.push_file(
+                        source_file, destination, count)
+            self._media_pushed[file_type] = time.time()
+            self.bytes_sent += os.path.getsize(source_file)
+            self._record_checksums(transfers)
+
+    def copy_shards(self, destination, count):
+        """Return the directory, first and last number of each shard of
+        count copies placed in destination"""
+        ranges = shards(count, self.files_per_directory)
+        return [(directory, first, last) for directory, (first, last) in
+                zip(shard_directories(destination, len(ranges)), ranges)]
+
+    def copy_transfers(self, source_file, destination, count):
+        """Return the (local, remote) files once count copies of a file are
+        placed in destination"""
+        names = duplicate_names(os.path.basename(source_file), count)
+        return [(source_file, posixpath.join(directory, name))
+                for directory, first, last in
+                self.copy_shards(destination, count)
+                for name in names[first - 1:last]]
+
+    def duplicate_file(self, source_file, destination, count):
+        """Push a file once and copy it on the device with a single script
+
+        The copies are named in the same way as gaiatest's file manager, and
+        are spread over directories when sharding. Neither the bytes pushed
+        nor the number of commands grow with count.
+        """
+        filename = os.path.basename(source_file)
+        remote_file = posixpath.join(destination, filename)
+        self.device.file_manager.make_dirs(remote_file)
+        size = os.path.getsize(source_file)
+        with self.metrics.phase('push', size):
+            self.device.manager.pushFile(source_file, remote_file)
+        base, dot, extension = filename.rpartition('.')
+        duplicate = dot and '%s_$i.%s' % (base, extension) or \
+            '%s_$i' % filename
+        # mozdevice wraps the script in single quotes, so it must not
+        # contain any
+        loops = []
+        for directory, first, last in self.copy_shards(destination, count):
+            loop = 'cd "%s" && i=%d && while [ $i -le %d ]; do ' \
+                   'cat "%s" > "%s" || exit 1; i=$((i + 1)); done' % (
+                       directory, first, last, remote_file, duplicate)
+            if directory != destination:
+                # the parent of each shard exists by now, so there is no
+                # need for mkdir -p, which older toolboxes lack
+                loop = '{ [ -d "%s" ] || mkdir "%s"; } && %s' % (
+                    directory, directory, loop)
+            loops.append(loop)
+        try:
+            with self.metrics.phase('copy', size * count, count):
+                for batch in self.command_batches(['sh', '-c'], loops,
+                                                  separator=' && '):
+                    self.device.manager.shellCheckOutput(
+                        ['sh', '-c', ' && '.join(batch)])
+        finally:
+            self.device.manager.removeFile(remote_file)
+
+    def push_tree(self, local_dir, remote_dir, batch=True):
+        """Push the files in a directory and in any directories within it
+
+        The files are bundled in a single archive if the device is able to
+        unpack it.
+        """
+        if batch and self.is_unzip_available:
+            archive = self.resources.archive(local_dir)
+            self.push_archive(archive, remote_dir,
+                              expected=os.listdir(local_dir))
+            self.resources.release(archive)
+        else:
+            self._logger.debug('Pushing %s to %s' % (local_dir, remote_dir))
+            self.push_dir(local_dir, remote_dir)
+        self._record_checksums(self.dir_transfers(local_dir, remote_dir))
+
+    def push_file(self, local, remote):
+        """Push a file unless it is already on the device"""
+        size = os.path.getsize(local)
+        if self.incremental and self.is_up_to_date(local, remote):
+            self._logger.debug('Skipping %s, already on the device' % remote)
+            self.bytes_skipped += size
+            return
+        if not (self.compress and self.push_compressed(
+                local, posixpath.dirname(remote), posixpath.basename(remote))):
+            with self.metrics.phase('push', size):
+                self.device.manager.pushFile(local, remote)
+            self.bytes_sent += size
+        self._record_checksums([(local, remote)])
+
+    def push_dir(self, local_dir, remote_dir):
+        transfers = changed = self.dir_transfers(local_dir, remote_dir)
+        if self.incremental and self.checksum_command:
+            self.fetch_checksums(set(
+                [posixpath.dirname(r) for l, r in transfers]))
+            changed = [(l, r) for l, r in transfers
+                       if not self.is_up_to_date(l, r)]
+            self._record_checksums(transfers)
+        if len(changed) < len(transfers):
+            # only push the files that differ from those on the device
+            self.bytes_skipped += sum([os.path.getsize(l) for l, r in
+                                       set(transfers) - set(changed)])
+            scheduler = TransferScheduler(self._logger, self.jobs)
+            for local, remote in changed:
+                scheduler.push_file(self.device.manager, local, remote)
+            if changed:
+                self.bytes_sent += self.run_transfers(
+                    scheduler, phase='push_dir')['bytes']
+        elif self.compress and self.push_compressed(local_dir, remote_dir):
+            return
+        else:
+            size, files = disk_usage(local_dir)
+            with self.metrics.phase('push_dir', size, files):
+                self.device.manager.pushDir(local_dir, remote_dir)
+            self.bytes_sent += size
+
+    def push_compressed(self, source, destination, name=None):
+        """Push a file or directory deflated and unpack it on the device
+
+        Returns false without pushing anything if unzip is not available on
+        the device or compressing saves too little to be worth unpacking,
+        in which case the caller pushes it uncompressed.
+        """
+        size, files = disk_usage(source)
+        if size < self.MIN_COMPRESS_SIZE or not self.is_unzip_available:
+            return False
+        start = time.time()
+        archive = self.resources.compressed(source, name)
+        try:
+            compressed_size = os.path.getsize(archive)
+            if compressed_size > size * self.MAX_COMPRESS_RATIO:
+                self._logger.debug(
+                    'Pushing %s uncompressed as it only compresses to %d of '
+                    '%d bytes' % (source, compressed_size, size))
+                return False
+            with ZipFile(archive) as zip_file:
+                names = set([n.split('/')[0] for n in zip_file.namelist()])
+            self.push_archive(archive, destination, expected=sorted(names))
+        finally:
+            self.resources.release(archive)
+        if os.path.isdir(source):
+            transfers = self.dir_transfers(source, destination)
+        else:
+            transfers = [(source, posixpath.join(destination, name))]
+        self.verify_transfers(transfers)
+        duration = time.time() - start
+        self.metrics.add('push_compressed', duration, size, files)
+        self._logger.info(
+            'Pushed %s as %d of %d bytes (%.1fx smaller) in %.2fs, an '
+            'effective %.1f KB/s' % (
+                source, compressed_size, size,
+                float(size) / max(compressed_size, 1), duration,
+                size / max(duration, 0.001) / 1024))
+        return True
+
+    def verify_transfers(self, transfers):
+        """Check that the remote files match their local copies
+
+        Files are compared by checksum, or only by size if neither md5sum
+        nor md5 are available.
+        """
+        if not self.checksum_command:
+            self.verify_sizes(transfers)
+            return
+        directories = set([posixpath.dirname(r) for l, r in transfers])
+        # fetch afresh as cached checksums may predate the transfer
+        self._checksummed.difference_update(directories)
+        self.fetch_checksums(directories)
+        mismatched = [r for l, r in transfers
+                      if not self.is_up_to_date(l, r)]
+        if mismatched:
+            raise B2GPopulateError(
+                'Checksums of %d files differ after unpacking: %s' % (
+                    len(mismatched), ', '.join(mismatched)))
+
+    def verify_sizes(self, transfers):
+        """Check that the remote files exist with the size of their local
+        copies"""
+        sizes = {}
+        for directory in sorted(set(
+                [posixpath.dirname(r) for l, r in transfers])):
+            output = StringIO()
+            self.device.manager.shell(['ls', '-l', directory], output)
+            for line in output.getvalue().splitlines():
+                fields = line.split()
+                if len(fields) < 6 or not fields[0].startswith('-'):
+                    continue
+                # toolbox leaves out the link count that busybox lists
+                size = fields[4] if fields[1].isdigit() else fields[3]
+                if size.isdigit():
+                    sizes[posixpath.join(directory, fields[-1])] = int(size)
+        mismatched = [r for l, r in transfers
+                      if not sizes.get(r) == os.path.getsize(l)]
+        if mismatched:
+            raise B2GPopulateError(
+                'Sizes of %d files differ after unpacking: %s' % (
+                    len(mismatched), ', '.join(mismatched)))
+
+    @property
+    def checksum_command(self):
+        if self._checksum_command is None:
+            self._checksum_command = ''
+            for command in ['md5sum', 'md5']:
+                if self.device.manager.shell(
+                        [command, '/dev/null'], StringIO()) == 0:
+                    self._checksum_command = command
+                    break
+            else:
+                self._logger.info('Unable to compare checksums as neither '
+                                  'md5sum nor md5 are available on the '
+                                  'device')
+        return self._checksum_command
+
+    def fetch_checksums(self, directories):
+        """Fetch the checksums of all files in directories in one call"""
+        directories = sorted(set(directories) - self._checksummed)
+        if not directories or not self.checksum_command:
+            return
+        self._logger.debug('Fetching checksums of files in %s' % (
+            ', '.join(directories)))
+        output = StringIO()
+        with self.metrics.phase('checksums', items=len(directories)):
+            # missing directories make the command fail, so ignore its status
+            self.device.manager.shell([self.checksum_command] + [
+                posixpath.join(d, '*') for d in directories], output)
+        for line in output.getvalue().splitlines():
+            parts = line.strip().split(None, 1)
+            if len(parts) == 2 and re.match('^[0-9a-f]{32}$', parts[0]):
+                self._checksums[parts[1]] = parts[0]
+        self._checksummed.update(directories)
+
+    def _record_checksums(self, transfers):
+        # the remote files now have the same content as the local ones
+        if self.incremental:
+            for local, remote in transfers:
+                self._checksums[remote] = self.local_checksum(local)
+
+    def _forget_checksums(self, prefix):
+        # the files have been removed or replaced on the device
+        for remote in self._checksums.keys():
+            if remote.startswith(prefix):
+                del self._checksums[remote]
+
+    def local_checksum(self, path):
+        if path not in self._local_checksums:
+            md5 = hashlib.md5()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), ''):
+                    md5.update(chunk)
+            self._local_checksums[path] = md5.hexdigest()
+        return self._local_checksums[path]
+
+    def is_up_to_date(self, local, remote):
+        """Check whether a remote file has the same content as a local one"""
+        self.fetch_checksums([posixpath.dirname(remote)])
+        return self._checksums.get(remote) == self.local_checksum(local)
+
+    def is_populated(self, transfers):
+        """Check whether every remote file matches its local copy
+
+        Always false unless populating incrementally. When true the local
+        files are counted as skipped.
+        """
+        if not self.incremental or not self.checksum_command:
+            return False
+        self.fetch_checksums(set(
+            [posixpath.dirname(remote) for local, remote in transfers]))
+        if not all([self.is_up_to_date(l, r) for l, r in transfers]):
+            return False
+        self.bytes_skipped += sum([os.path.getsize(local) for local in set(
+            [local for local, remote in transfers])])
+        return True
 
     def remove_media(self, file_type):
         if self.device.is_android_build:
@@ -368,18 +1809,98 @@ class B2GPopulate(object):
             if len(files) > 0:
                 self._logger.info('Removing %d %s files' % (
                     len(files), file_type))
-                volumes = self.get_volumes()
+                paths = {}
                 for filename in files:
-                    # Get the actual location of the file
-                    parts = filename.strip(posixpath.sep).partition(posixpath.sep)
-                    path = posixpath.join(volumes[parts[0]], parts[2])
-                    self._logger.debug('Removing %s' % path)
-                    self.device.file_manager.remove(path)
+                    volume, path = self.media_path(filename)
+                    paths.setdefault(volume, []).append(path)
+                # volumes are independent, so clear them in parallel
+                scheduler = TransferScheduler(self._logger, len(paths))
+                for volume in sorted(paths):
+                    for batch in self.command_batches(
+                            ['rm', '-r'], paths[volume]):
+                        scheduler.add(
+                            ' '.join(batch),
+                            self.device.manager.shellCheckOutput,
+                            (['rm', '-r'] + batch,), files=len(batch))
+                    for path in paths[volume]:
+                        self._checksums.pop(path, None)
+                self.run_transfers(scheduler, phase='remove_media',
+                                   action='Removed')
                 files = getattr(self.data_layer, '%s_files' % file_type) or []
             if not len(files) == 0:
                 raise IncorrectCountError(
                     '%s files' % file_type, 0, len(files))
 
+    def media_path(self, filename):
+        """Return the volume and actual location of a media file"""
+        volume, sep, relative = filename.strip(posixpath.sep).partition(
+            posixpath.sep)
+        return volume, posixpath.join(self.volumes[volume], relative)
+
+    def command_batches(self, command, args, separator=' '):
+        """Split args into as few batches as fit on a shell command line"""
+        batches = []
+        length = self.MAX_COMMAND_LENGTH
+        for arg in args:
+            # allow for the separator and any quoting added by mozdevice
+            arg_length = len(arg) + len(separator) + 2
+            if length + arg_length > self.MAX_COMMAND_LENGTH:
+                batches.append([])
+                length = len(' '.join(command))
+            batches[-1].append(arg)
+            length += arg_length
+        return batches
+
+    def media_count(self, file_type):
+        return len(getattr(self.data_layer, '%s_files' % file_type) or [])
+
+    @property
+    def is_unzip_available(self):
+        if self._unzip_available is None:
+            output = StringIO()
+            self.device.manager.shell(['unzip'], output)
+            self._unzip_available = 'Usage' in output.getvalue()
+            self._logger.debug('Unzip is %savailable on the device' % (
+                '' if self._unzip_available else 'not '))
+        return self._unzip_available
+
+    def push_archive(self, archive, destination, expected=None,
+                     staging=None):
+        """Push a zip archive and unpack it on the device
+
+        The archive is pushed to staging, which defaults to the destination.
+        If expected is given, the names it contains must all be present in
+        the destination once the archive has been unpacked.
+        """
+        remote_archive = posixpath.join(
+            staging or destination,
+            'b2gpopulate_%s' % os.path.basename(archive))
+        self._logger.debug('Pushing %s to %s' % (archive, remote_archive))
+        size = os.path.getsize(archive)
+        with self.metrics.phase('push', size):
+            self.device.manager.pushFile(archive, remote_archive)
+        self.bytes_sent += size
+        self._logger.debug('Unpacking %s to %s' % (
+            remote_archive, destination))
+        try:
+            with self.metrics.phase('unzip', size, len(expected or [])):
+                self.device.manager.shellCheckOutput(
+                    ['unzip', '-o', remote_archive, '-d', destination])
+        finally:
+            self.device.manager.removeFile(remote_archive)
+        if expected is not None:
+            remote_files = set(self.device.manager.listFiles(destination))
+            found = len([f for f in expected if f in remote_files])
+            if not found == len(expected):
+                raise IncorrectCountError(
+                    'files in %s' % destination, len(expected), found)
+
+    @property
+    def volumes(self):
+        if self._volumes is None:
+            self._volumes = self.get_volumes()
+        return self._volumes
+
     def get_volumes(self):
         version = int(self.device.manager.shellCheckOutput(
             ['getprop', 'ro.build.version.sdk']))
@@ -389,21 +1910,366 @@ class B2GPopulate(object):
         vlist = self.device.manager.shellCheckOutput(['vdc', 'volume', 'list'])
         return dict([v.split()[start:end] for v in vlist.splitlines()[:-1]])
 
+    def stop_b2g(self):
+        self._logger.debug('Stopping B2G')
+        with self.metrics.phase('stop_b2g'):
+            self.device.stop_b2g()
+
     def start_b2g(self):
         self._logger.debug('Starting B2G')
-        self.device.start_b2g(self.start_timeout)
+        with self.metrics.phase('start_b2g'):
+            self.device.start_b2g(self.start_timeout)
+        from gaiatest import GaiaData
         self.data_layer = GaiaData(self.marionette)
 
+    def run_transfers(self, scheduler, phase='push', action='Transferred'):
+        """Run the scheduled transfers and record them as a phase"""
+        with self.metrics.phase(phase) as record:
+            totals = scheduler.run(action=action)
+            record['bytes'], record['items'] = totals['bytes'], totals['files']
+        return totals
+
+
+def create_plan(populate, resources, start_timeout=60, jobs=1,
+                call_count=None, contact_count=None, message_count=None,
+                music_count=None, picture_count=None, video_count=None,
+                event_count=None):
+    """Return the plan of steps needed to populate the given counts
+
+    Host steps create the local resources while the device is stopping or
+    starting B2G. The populate argument is only used when the plan is run,
+    so a plan can be built and printed without a device.
+    """
+    logger = populate and populate._logger or resources._logger
+    journal = populate and populate.journal
+    plan = planner.Plan(logger, host_jobs=multiprocessing.cpu_count(),
+                        journal=journal)
+    db_counts = dict([(k, v) for k, v in [
+        ('call_count', call_count), ('contact_count', contact_count),
+        ('message_count', message_count), ('event_count', event_count)]
+        if v is not None])
+    all_counts = dict(db_counts, music_count=music_count,
+                      picture_count=picture_count, video_count=video_count)
+    if populate:
+        # create the working directory before steps race to do so
+        resources.path
+
+    prepared = {}
+    for data_type in ['call', 'contact', 'event', 'message']:
+        count = db_counts.get('%s_count' % data_type)
+        if count is None:
+            continue
+        size = resources.database_size(data_type, count)
+        estimate = float(size) / ESTIMATED_EXTRACT_RATE
+        if count != template_marker(data_type, count):
+            estimate += float(count) / ESTIMATED_GENERATE_RATE
+        prepared[data_type] = plan.add(
+            'prepare %d %ss' % (count, data_type),
+            lambda c=count, t=data_type: resources.prepare(
+                **{'%s_count' % t: c}),
+            lane=planner.HOST, estimate=estimate)
+
+    checksums = None
+    if populate and populate.incremental:
+        # the databases are compared once they have been prepared
+        checksums = plan.add(
+            'fetch checksums',
+            lambda: populate.fetch_target_checksums(**all_counts),
+            after=prepared.values(), estimate=ESTIMATED_COMMAND_TIME)
+
+    if music_count:
+        albums = bool(populate and populate.files_per_directory)
+        prepared['music'] = plan.add(
+            'prepare %d music files' % music_count,
+            lambda: resources.music(music_count, albums=albums),
+            lane=planner.HOST, estimate=music_count * ESTIMATED_TAG_TIME)
+    unique_media = bool(populate and populate.unique_media)
+    for file_type, count, source in [
+            ('picture', picture_count, 'IMG_0001.jpg'),
+            ('video', video_count, 'VID_0001.3gp')]:
+        if count and unique_media:
+            # generated for the default destination of pictures and videos
+            prepared[file_type] = plan.add(
+                'prepare %d %s files' % (count, file_type),
+                lambda t=file_type, c=count, s=source: resources.variants(
+                    c, s, posixpath.basename(media_directory(
+                        t, populate.files_per_directory)),
+                    populate.files_per_directory),
+                lane=planner.HOST, estimate=count * ESTIMATED_VARIANT_TIME)
+
+    state = {'stopped': False}
+    stop = start = None
+    if db_counts:
+        pushes = ['push %d %ss' % (db_counts['%s_count' % t], t) for t in
+                  ['call', 'contact', 'event', 'message']
+                  if '%s_count' % t in db_counts]
+
+        def stop_b2g():
+            if journal is not None and all([p in journal for p in pushes]):
+                populate._logger.info('The databases were pushed by an '
+                                      'earlier run')
+                # which may have ended before starting B2G again
+                state['stopped'] = True
+                return
+            if populate.databases_populated(**db_counts):
+                populate._logger.info('The databases are already on the '
+                                      'device, leaving B2G running')
+                return
+            populate.stop_b2g()
+            state['stopped'] = True
+        stop = plan.add('stop B2G', stop_b2g, after=[checksums],
+                        estimate=ESTIMATED_STOP_TIME)
+
+        pushed = []
+        for data_type in ['call', 'contact', 'event', 'message']:
+            count = db_counts.get('%s_count' % data_type)
+            if count is None:
+                continue
+            size = resources.database_size(data_type, count)
+            pushed.append(plan.add(
+                'push %d %ss' % (count, data_type),
+                lambda c=count, t=data_type: getattr(
+                    populate, 'populate_%ss' % t)(c, restart=False),
+                after=[stop, prepared[data_type]],
+                estimate=float(size) / ESTIMATED_PUSH_RATE, resumable=True))
+
+        def start_b2g():
+            if state['stopped']:
+                populate.start_b2g()
+        start = plan.add('start B2G', start_b2g, after=pushed,
+                         estimate=min(start_timeout, ESTIMATED_START_TIME),
+                         resumable=True)
+
+    # media is removed and verified through the data layer, so B2G must be
+    # running; the steps are chained to keep the order predictable
+    previous = start or checksums
+    if music_count is not None:
+        size = music_count and os.path.getsize(
+            resources.resource('MUS_0001.mp3')) * music_count
+        previous = plan.add(
+            'push %d music files' % music_count,
+            lambda: populate.populate_music(music_count),
+            after=[previous, prepared.get('music')],
+            estimate=float(size) / ESTIMATED_PUSH_RATE +
+            ESTIMATED_COMMAND_TIME, resumable=True)
+    for file_type, count, source in [
+            ('picture', picture_count, 'IMG_0001.jpg'),
+            ('video', video_count, 'VID_0001.3gp')]:
+        if count is None:
+            continue
+        size = os.path.getsize(resources.resource(source))
+        if unique_media:
+            # every copy is pushed rather than copied on the device
+            estimate = float(size) * count / ESTIMATED_PUSH_RATE + \
+                2 * ESTIMATED_COMMAND_TIME
+        else:
+            estimate = float(size) / ESTIMATED_PUSH_RATE + \
+                2 * ESTIMATED_COMMAND_TIME + \
+                float(size) * count / ESTIMATED_COPY_RATE
+        previous = plan.add(
+            'push %d %s files' % (count, file_type),
+            lambda t=file_type, c=count: getattr(
+                populate, 'populate_%ss' % t)(c),
+            after=[previous, prepared.get(file_type)],
+            estimate=estimate, resumable=True)
+    media_counts = dict([(k, v) for k, v in [
+        ('music_count', music_count), ('picture_count', picture_count),
+        ('video_count', video_count)] if v is not None])
+    if populate and media_counts:
+        # B2G indexes media some time after it is pushed, so the counts are
+        # only checked once it reports them in full
+        timeout = populate.index_timeout
+        if timeout is None:
+            timeout = DEFAULT_INDEX_TIMEOUT
+        previous = plan.add(
+            'wait for media indexing',
+            lambda: populate.wait_for_media(timeout=timeout, **media_counts),
+            after=[previous], estimate=ESTIMATED_COMMAND_TIME)
+    if previous:
+        plan.add('verify counts',
+                 lambda: populate.verify_counts(**all_counts),
+                 after=[previous], estimate=ESTIMATED_COMMAND_TIME)
+    return plan
+
+
+def planned_transfers(resources, call_count=None, contact_count=None,
+                      message_count=None, music_count=None,
+                      picture_count=None, video_count=None,
+                      event_count=None, unique_media=False):
+    """Return what populating the given counts would push to a device
+
+    Each transfer is a (content, files, bytes, source) tuple worked out from
+    the packaged resources without preparing any of them. Pictures and
+    videos are pushed once and copied on the device, unless unique_media is
+    true and every copy is pushed.
+    """
+    transfers = []
+    for data_type, count in [('call', call_count),
+                             ('contact', contact_count),
+                             ('event', event_count),
+                             ('message', message_count)]:
+        if count is None:
+            continue
+        marker = template_marker(data_type, count)
+        if not os.path.exists(resources.database_archive(
+                DATABASES[data_type][0])):
+            source = 'missing'
+        elif count == marker:
+            source = 'prebuilt'
+        else:
+            source = 'generated from %d' % marker
+        transfers.append(('%d %ss' % (count, data_type), 1,
+                          resources.database_size(data_type, count), source))
+        if data_type == 'contact' and count > 0:
+            transfers.append(('contact pictures',) + resources.archive_usage(
+                'contactsPictures.zip') + ('prebuilt',))
+        if data_type == 'message' and count > 0:
+            transfers.append(('message attachments',) +
+                             resources.archive_usage(
+                                 'smsAttachments.zip',
+                                 'smsAttachments-%d.zip' % marker) +
+                             ('prebuilt',))
+    for file_type, count, source in [('music', music_count, 'MUS_0001.mp3'),
+                                     ('picture', picture_count,
+                                      'IMG_0001.jpg'),
+                                     ('video', video_count, 'VID_0001.3gp')]:
+        if not count:
+            continue
+        path = resources.resource(source)
+        size = os.path.exists(path) and os.path.getsize(path) or 0
+        content = '%d %s files' % (count, file_type)
+        if file_type == 'music':
+            transfers.append((content, count, count * size,
+                              'copies of %s' % source))
+        elif unique_media:
+            transfers.append((content, count, count * size,
+                              'variants of %s' % source))
+        elif count == 1:
+            transfers.append((content, 1, size, source))
+        else:
+            transfers.append((content, 1, size, '%s, copied %d times on the '
+                              'device' % (source, count)))
+    return transfers
+
+
+def print_transfers(transfers):
+    row = '%-22s %8s %12s  %s'
+    print row % ('Content', 'Files', 'Bytes', 'Source')
+    for content, files, size, source in transfers:
+        print row % (content, files, size, source)
+    print (row % ('Total', sum([t[1] for t in transfers]),
+                  sum([t[2] for t in transfers]), '')).rstrip()
+
+
+def connect(address):
+    try:
+        host, port = address.split(':')
+    except ValueError:
+        raise B2GPopulateError('--address must be in the format host:port')
+
+    from marionette import Marionette
+    marionette = Marionette(host=host, port=int(port), timeout=180000)
+    marionette.start_session()
+    return marionette
+
+
+def _populate_device(args):
+    serial, address, counts, options, resources_path, restore = args
+    start = time.time()
+    error = None
+    resources = LocalResources(resources_path, shared=True)
+    options = dict(options)
+    resume = options.pop('resume', False)
+    if not restore:
+        options['journal'] = Journal(journal_path(JOURNAL_DIR, serial, counts),
+                                     serial, counts, resume=resume)
+    try:
+        b2gpopulate = B2GPopulate(connect(address), device_serial=serial,
+                                  resources=resources, **options)
+        if restore:
+            b2gpopulate.restore(restore)
+        else:
+            b2gpopulate.populate(**counts)
+    except Exception as e:
+        error = '%s: %s' % (type(e).__name__, e)
+    return {'serial': serial,
+            'address': address,
+            'duration': time.time() - start,
+            'error': error,
+            'phases': resources.metrics.summary()}
+
+
+def populate_devices(devices, processes=None, start_timeout=60, jobs=1,
+                     resources=None, incremental=False, compress=False,
+                     restore=None, resume=False, files_per_directory=None,
+                     index_timeout=None, unique_media=False, **counts):
+    """Populate several devices in parallel
+
+    Each device is a (serial, address) pair and is populated by its own
+    process. Content is prepared on the host once, in resources if given,
+    and shared by every device. Progress is journaled for each device, and
+    resumed from an earlier journal if resume is true. If restore is given,
+    that snapshot is restored to each device instead. Returns the duration
+    and error (if any) for each device.
+    """
+    resources = resources or LocalResources(shared=True)
+    try:
+        if not restore:
+            resources.prepare(albums=bool(files_per_directory), **dict(
+                (k, v) for k, v in counts.items() if k not in [
+                    'picture_count', 'video_count']))
+            for file_type, source in [('picture', 'IMG_0001.jpg'),
+                                      ('video', 'VID_0001.3gp')]:
+                count = counts.get('%s_count' % file_type)
+                if count and unique_media:
+                    resources.variants(count, source, posixpath.basename(
+                        media_directory(file_type, files_per_directory)),
+                        files_per_directory)
+        options = {'start_timeout': start_timeout,
+                   'jobs': jobs,
+                   'incremental': incremental,
+                   'compress': compress,
+                   'resume': resume,
+                   'files_per_directory': files_per_directory,
+                   'index_timeout': index_timeout,
+                   'unique_media': unique_media}
+        pool = multiprocessing.Pool(processes or len(devices))
+        try:
+            return pool.map(_populate_device, [
+                (serial, address, counts, options, resources.path, restore)
+                for serial, address in devices])
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        resources.cleanup()
+
+
+def print_summary(results):
+    row = '%-20s %-20s %10s  %s'
+    print row % ('Serial', 'Address', 'Time (s)', 'Result')
+    for result in results:
+        print row % (result['serial'] or '-', result['address'],
+                     '%.1f' % result['duration'], result['error'] or 'OK')
+    populated = len([r for r in results if not r['error']])
+    print '%d device%s populated, %d failed' % (
+        populated, '' if populated == 1 else 's', len(results) - populated)
+
 
 def cli():
+    from mozlog.structured import commandline
+
     parser = argparse.ArgumentParser(
         description='Content population tool for Firefox OS')
     parser.add_argument(
         '--address',
-        default='localhost:2828',
-        help='address of marionette server (default: %(default)s)')
+        action='append',
+        help='address of marionette server (default: localhost:2828). '
+             'repeat along with --device-serial to populate several '
+             'devices in parallel')
     parser.add_argument(
         '--device-serial',
+        action='append',
         metavar='SERIAL',
         help='serial identifier of device to target')
     parser.add_argument(
@@ -417,28 +2283,32 @@ def cli():
         type=int,
         dest='call_count',
         metavar='CALLS',
-        help='number of calls to create. must be one of: %s' %
+        help='number of calls to create. prebuilt databases are used for: '
+             '%s and are generated for any other count' %
              sorted([WORKLOADS[k]['call'] for k in WORKLOADS.keys()]))
     parser.add_argument(
         '--contacts',
         type=int,
         dest='contact_count',
         metavar='CONTACTS',
-        help='number of contacts to create. must be one of: %s' %
+        help='number of contacts to create. prebuilt databases are used for: '
+             '%s and are generated for any other count' %
              sorted([WORKLOADS[k]['contact'] for k in WORKLOADS.keys()]))
     parser.add_argument(
         '--events',
         type=int,
         dest='event_count',
         metavar='EVENTS',
-        help='number of events to create. must be one of: %s' %
+        help='number of events to create. prebuilt databases are used for: '
+             '%s and are generated for any other count' %
              sorted([WORKLOADS[k]['event'] for k in WORKLOADS.keys()]))
     parser.add_argument(
         '--messages',
         type=int,
         dest='message_count',
         metavar='MESSAGES',
-        help='number of messages to create. must be one of: %s' %
+        help='number of messages to create. prebuilt databases are used for: '
+             '%s and are generated for any other count' %
              sorted([WORKLOADS[k]['message'] for k in WORKLOADS.keys()]))
     parser.add_argument(
         '--music',
@@ -464,10 +2334,91 @@ def cli():
         choices=sorted(WORKLOADS, key=WORKLOADS.__getitem__),
         help='type of workload to create. must be one of: %s' %
              sorted(WORKLOADS, key=WORKLOADS.__getitem__))
-    structured.commandline.add_logging_group(parser)
+    parser.add_argument(
+        '--cache-dir',
+        metavar='DIR',
+        help='directory to keep extracted and generated content in between '
+             'runs')
+    parser.add_argument(
+        '--cache-size',
+        type=int,
+        default=1024,
+        metavar='MB',
+        help='maximum size of the cache in megabytes (default: %(default)s)')
+    parser.add_argument(
+        '--metrics-json',
+        metavar='PATH',
+        help='write the time, bytes and items of each phase to a JSON file')
+    parser.add_argument(
+        '--plan',
+        action='store_true',
+        help='print the steps that would be run along with their estimated '
+             'schedule and critical path, without populating')
+    parser.add_argument(
+        '--dry-run',
+        action='store_true',
+        help='print the content that would be pushed to the device and its '
+             'size, without populating')
+    parser.add_argument(
+        '--snapshot',
+        metavar='PATH',
+        help='capture the databases and media on the device in an image '
+             'once populated, or as they are if nothing is to be populated')
+    parser.add_argument(
+        '--restore',
+        metavar='PATH',
+        help='restore an image captured with --snapshot instead of '
+             'populating')
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help='only push content that differs from what is on the device')
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help='skip the steps completed by an earlier run that was '
+             'interrupted while populating the same device with the same '
+             'counts')
+    parser.add_argument(
+        '--compress',
+        action='store_true',
+        help='push databases and directories deflated and unpack them on '
+             'the device, which is faster over slow connections')
+    parser.add_argument(
+        '--files-per-directory',
+        type=int,
+        metavar='FILES',
+        help='spread pictures and videos over DCIM directories of at most '
+             'this many files each, and place music in a directory per '
+             'album')
+    parser.add_argument(
+        '--wait-for-indexing',
+        type=int,
+        dest='index_timeout',
+        metavar='TIMEOUT',
+        help='once media is pushed, wait up to this many seconds for B2G to '
+             'report every file before checking the counts, and log how '
+             'long each media type took (default: %d)' % (
+                 DEFAULT_INDEX_TIMEOUT))
+    parser.add_argument(
+        '--unique-media',
+        action='store_true',
+        help='give each picture and video metadata of its own so that no '
+             'two files are identical, at the cost of pushing every file')
+    parser.add_argument(
+        '--jobs',
+        type=int,
+        default=1,
+        metavar='JOBS',
+        help='number of concurrent adb transfers of the changed files of '
+             'an incremental population, the files pulled by --snapshot, '
+             'and the databases and directories pushed by --restore '
+             'without unzip. Otherwise each resource is pushed as a '
+             'whole, one at a time (default: %(default)s)')
+    commandline.add_logging_group(parser)
 
     args = parser.parse_args()
-    structured.commandline.setup_logging(
+    commandline.setup_logging(
         'b2gpopulate', args, {'mach': sys.stdout})
 
     data_types = WORKLOADS['empty'].keys()
@@ -477,11 +2428,27 @@ def cli():
             parser.print_usage()
             print 'Invalid value for %s count!' % data_type
             parser.exit()
+    if args.files_per_directory is not None and \
+            not args.files_per_directory > 0:
+        parser.print_usage()
+        print 'Invalid number of files per directory!'
+        parser.exit()
 
     counts = [getattr(args, '%s_count' % data_type) for
               data_type in data_types]
-    if not len([count for count in counts if count >= 0]) > 0:
-        if args.workload is None:
+    if args.snapshot and args.restore:
+        parser.print_usage()
+        print 'Please specify either a snapshot or an image to restore'
+        parser.exit()
+    if args.restore:
+        if args.workload is not None or any(
+                [count is not None for count in counts]):
+            parser.print_usage()
+            print 'Please specify either an image to restore or items to ' \
+                  'populate'
+            parser.exit()
+    elif not len([count for count in counts if count >= 0]) > 0:
+        if args.workload is None and not args.snapshot:
             parser.print_usage()
             print 'Must specify at least one item to populate'
             parser.exit()
@@ -491,42 +2458,109 @@ def cli():
             print 'Please specify either a workload or individual values'
             parser.exit()
 
-    # only allow preset values for calls, messages, contacts, events
-    for data_type in ['call', 'message', 'contact', 'event']:
-        count = getattr(args, '%s_count' % data_type)
-        preset_counts = [WORKLOADS[k][data_type] for k in WORKLOADS.keys()]
-        if count and count not in preset_counts:
-            raise InvalidCountError(data_type)
+    if args.workload is None:
+        counts = dict(('%s_count' % data_type,
+                       getattr(args, '%s_count' % data_type))
+                      for data_type in data_types)
+    else:
+        counts = dict(('%s_count' % data_type,
+                       WORKLOADS[args.workload][data_type])
+                      for data_type in data_types)
 
-    try:
-        host, port = args.address.split(':')
-    except ValueError:
-        raise B2GPopulateError('--address must be in the format host:port')
+    resources = None
+    if args.cache_dir:
+        resources = ResourceCache(args.cache_dir,
+                                  max_size=args.cache_size * 1024 * 1024)
 
-    marionette = Marionette(host=host, port=int(port), timeout=180000)
-    marionette.start_session()
-    b2gpopulate = B2GPopulate(marionette,
-                              start_timeout=args.start_timeout,
-                              device_serial=args.device_serial)
+    if args.dry_run:
+        resources = resources or LocalResources()
+        print_transfers(planned_transfers(resources,
+                                          unique_media=args.unique_media,
+                                          **counts))
+        missing = missing_resources(resources, [
+            data_type for data_type in data_types
+            if counts['%s_count' % data_type] is not None])
+        if missing:
+            sys.exit('\n'.join([
+                'Unable to populate %ss as %s is missing' % (
+                    data_type, path) for data_type in missing
+                for path in required_resources(resources, data_type)
+                if not os.path.exists(path)]))
+        return
 
-    if args.workload is None:
-        b2gpopulate.populate(
-            args.call_count,
-            args.contact_count,
-            args.message_count,
-            args.music_count,
-            args.picture_count,
-            args.video_count,
-            args.event_count)
-    else:
-        b2gpopulate.populate(
-            WORKLOADS[args.workload]['call'],
-            WORKLOADS[args.workload]['contact'],
-            WORKLOADS[args.workload]['message'],
-            WORKLOADS[args.workload]['music'],
-            WORKLOADS[args.workload]['picture'],
-            WORKLOADS[args.workload]['video'],
-            WORKLOADS[args.workload]['event'])
+    if args.plan:
+        print create_plan(None, resources or LocalResources(),
+                          start_timeout=args.start_timeout, jobs=args.jobs,
+                          **counts).format()
+        return
+
+    addresses = args.address or ['localhost:2828']
+    serials = args.device_serial or [None]
+    if len(addresses) > 1 or len(serials) > 1:
+        if not len(addresses) == len(serials):
+            parser.print_usage()
+            print 'Please specify an address for each device serial'
+            parser.exit()
+        if args.snapshot:
+            parser.print_usage()
+            print 'Please specify a single device to take a snapshot of'
+            parser.exit()
+        results = populate_devices(zip(serials, addresses),
+                                   start_timeout=args.start_timeout,
+                                   jobs=args.jobs,
+                                   incremental=args.incremental,
+                                   compress=args.compress,
+                                   restore=args.restore,
+                                   resume=args.resume,
+                                   files_per_directory=(
+                                       args.files_per_directory),
+                                   index_timeout=args.index_timeout,
+                                   unique_media=args.unique_media,
+                                   resources=resources,
+                                   **counts)
+        print_summary(results)
+        if args.metrics_json:
+            with open(args.metrics_json, 'w') as f:
+                json.dump({'devices': results}, f, indent=2)
+        if resources:
+            resources.report()
+        if any([r['error'] for r in results]):
+            sys.exit(1)
+        return
+
+    populating = not args.restore and any(
+        [count is not None for count in counts.values()])
+    journal = None
+    if populating:
+        journal = Journal(journal_path(JOURNAL_DIR, serials[0], counts),
+                          serials[0], counts, resume=args.resume)
+    b2gpopulate = B2GPopulate(connect(addresses[0]),
+                              start_timeout=args.start_timeout,
+                              device_serial=serials[0],
+                              jobs=args.jobs,
+                              resources=resources,
+                              incremental=args.incremental,
+                              compress=args.compress,
+                              journal=journal,
+                              files_per_directory=args.files_per_directory,
+                              index_timeout=args.index_timeout,
+                              unique_media=args.unique_media)
+    start = time.time()
+    if args.restore:
+        b2gpopulate.restore(args.restore)
+    elif populating:
+        b2gpopulate.populate(**counts)
+    if args.snapshot:
+        b2gpopulate.snapshot(args.snapshot)
+    if args.metrics_json:
+        b2gpopulate.metrics.write(args.metrics_json,
+                                  serial=serials[0],
+                                  address=addresses[0],
+                                  duration=round(time.time() - start, 3),
+                                  bytes_sent=b2gpopulate.bytes_sent,
+                                  bytes_skipped=b2gpopulate.bytes_skipped)
+    if resources:
+        resources.report()
 
 
 if __name__ == '__main__':
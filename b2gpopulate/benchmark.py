@@ -0,0 +1,685 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Benchmark population against a simulated device
+
+The simulated device keeps its file system in memory and implements the
+parts of mozdevice's device manager, gaiatest's device and Marionette that
+b2gpopulate uses. Every adb command costs a fixed latency, and pushing or
+pulling data is limited by a bandwidth that is shared between concurrent
+transfers as it would be over USB. Looking up a file in device storage costs
+a fixed time for each entry of its directory, as it does on FAT file
+systems, which makes both creating media files and the scan that B2G runs
+over them slower in large directories. New files in device storage can
+also be made to appear to B2G only once they have been indexed, one after
+another at a fixed rate.
+
+    python -m b2gpopulate.benchmark --workload light --latency 20
+"""
+
+import argparse
+from collections import Counter
+import fnmatch
+import hashlib
+import os
+import posixpath
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from zipfile import ZipFile
+
+from gaiatest.file_manager import GaiaDeviceFileManager
+import mozdevice
+from mozlog import structured
+
+from b2gpopulate import B2GPopulate
+from b2gpopulate import COUNT_SCRIPT
+from b2gpopulate import LocalResources
+from b2gpopulate import ResourceCache
+from b2gpopulate import WORKLOADS
+from b2gpopulate import missing_resources
+
+WEBAPPS = '''{
+  "communications.gaiamobile.org": {"localId": 11},
+  "calendar.gaiamobile.org": {"localId": 12}
+}'''
+
+MEDIA_TYPES = {
+    'getAllMusic': ['.mp3', '.ogg'],
+    'getAllPictures': ['.jpg', '.png'],
+    'getAllVideos': ['.3gp', '.mp4', '.webm']}
+
+
+class SimulatedDeviceManager(mozdevice.DeviceManager):
+    """In-memory device manager with a cost for each adb command"""
+
+    def __init__(self, latency=0.01, bandwidth=10 * 1024 * 1024,
+                 unzip=True, lookup_time=0.000001, index_rate=None):
+        mozdevice.DeviceManager.__init__(self, deviceRoot='/sdcard')
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.unzip = unzip
+        self.lookup_time = lookup_time
+        self.index_rate = index_rate
+        self.scan_time = 0
+        # path -> time at which B2G will have indexed it
+        self.indexed_at = {}
+        self._indexed_until = 0
+        # directory -> number of files in it
+        self.entries = Counter()
+        # content of files by md5, either in the store or as a member of an
+        # archive that was unpacked
+        self.store = tempfile.mkdtemp(prefix='b2gpopulate-device-')
+        self.members = {}
+        # path -> (size, md5)
+        self.files = {'/data/local/webapps/webapps.json': (
+            len(WEBAPPS), self._keep_data(WEBAPPS))}
+        self.dirs = set(['/'])
+        self.calls = Counter()
+        self.bytes = Counter()
+        self._lock = threading.Lock()
+        self._link = threading.Lock()
+        self._md5s = {}
+        # md5 -> (name, records in each object store) of a database
+        self.records = {}
+
+    def _command(self, name, size=0):
+        with self._lock:
+            self.calls[name] += 1
+            self.bytes[name] += size
+        time.sleep(self.latency)
+        if size:
+            with self._link:
+                time.sleep(float(size) / self.bandwidth)
+
+    def cleanup(self):
+        shutil.rmtree(self.store, ignore_errors=True)
+
+    def _md5(self, path):
+        if path not in self._md5s:
+            self._md5s[path] = hashlib.md5(open(path, 'rb').read()).hexdigest()
+        return self._md5s[path]
+
+    def _keep(self, local):
+        """Keep the content of a local file, returning its md5"""
+        md5 = self._md5(local)
+        path = os.path.join(self.store, md5)
+        if not os.path.exists(path):
+            # local content is never changed in place, so a link is as good
+            # as a copy and much cheaper
+            try:
+                os.link(local, path)
+            except OSError:
+                shutil.copyfile(local, path)
+        return md5
+
+    def _keep_data(self, data):
+        md5 = hashlib.md5(data).hexdigest()
+        path = os.path.join(self.store, md5)
+        if not os.path.exists(path):
+            with open(path, 'wb') as f:
+                f.write(data)
+        return md5
+
+    def _content(self, md5):
+        path = os.path.join(self.store, md5)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                return f.read()
+        archive, name = self.members[md5]
+        return ZipFile(os.path.join(self.store, archive)).read(name)
+
+    def _add(self, remote, size, md5):
+        """Add a file, returning the directory entries looked through to
+        create it in device storage"""
+        remote = posixpath.normpath(remote)
+        with self._lock:
+            entries = 0
+            if remote.startswith(self.deviceRoot + '/'):
+                entries = self.entries[posixpath.dirname(remote)]
+                if self.index_rate:
+                    self._indexed_until = max(
+                        self._indexed_until, time.time()) + \
+                        1.0 / self.index_rate
+                    self.indexed_at[remote] = self._indexed_until
+            if remote not in self.files:
+                self.entries[posixpath.dirname(remote)] += 1
+            self.files[remote] = (size, md5)
+            parent = posixpath.dirname(remote)
+            while parent not in self.dirs:
+                self.dirs.add(parent)
+                parent = posixpath.dirname(parent)
+        return entries
+
+    def _lookup(self, entries):
+        time.sleep(entries * self.lookup_time)
+
+    def scan(self, paths):
+        """Take as long as B2G would to look up each of the files"""
+        entries = Counter([posixpath.dirname(path) for path in paths])
+        duration = sum([n * (n + 1) / 2 for n in entries.values()]) * \
+            self.lookup_time
+        with self._lock:
+            self.scan_time += duration
+        time.sleep(duration)
+
+    def _remove(self, remote):
+        remote = posixpath.normpath(remote)
+        with self._lock:
+            for path in self.files.keys():
+                if path == remote or path.startswith(remote + '/'):
+                    del self.files[path]
+                    self.entries[posixpath.dirname(path)] -= 1
+                    self.indexed_at.pop(path, None)
+            for path in list(self.dirs):
+                if path == remote or path.startswith(remote + '/'):
+                    self.dirs.discard(path)
+
+    def _load_database(self, md5, path):
+        if md5 not in self.records:
+            db = sqlite3.connect(path)
+            try:
+                self.records[md5] = (
+                    db.execute('SELECT name FROM database').fetchone()[0],
+                    dict(db.execute(
+                        'SELECT name, (SELECT COUNT(*) FROM object_data '
+                        'WHERE object_store_id = object_store.id) '
+                        'FROM object_store')))
+            finally:
+                db.close()
+
+    def count_records(self, name, store):
+        """Return the records in a store of a database on the device, as
+        B2G would load them"""
+        with self._lock:
+            md5s = [md5 for size, md5 in self.files.values()]
+        for md5 in md5s:
+            if self.records.get(md5, (None, {}))[0] == name:
+                return self.records[md5][1].get(store)
+        return None
+
+    def _setupDeviceRoot(self, deviceRoot=None):
+        return deviceRoot
+
+    def pushFile(self, localFilename, remoteFilename, retryLimit=1,
+                 createDir=True):
+        size = os.path.getsize(localFilename)
+        self._command('pushFile', size)
+        md5 = self._keep(localFilename)
+        if remoteFilename.endswith('.sqlite'):
+            self._load_database(md5, localFilename)
+        self._lookup(self._add(remoteFilename, size, md5))
+
+    def pushDir(self, localDirname, remoteDirname, retryLimit=1,
+                timeout=None):
+        # mozdevice zips the directory and unpacks it on the device
+        files = []
+        for root, dirs, filenames in os.walk(localDirname):
+            relative = os.path.relpath(root, localDirname)
+            files.extend([(os.path.join(root, f), posixpath.normpath(
+                posixpath.join(remoteDirname, relative, f)))
+                for f in filenames])
+        self._command('pushDir', sum([os.path.getsize(l) for l, r in files]))
+        self._lookup(sum([self._add(remote, os.path.getsize(local),
+                                    self._keep(local))
+                          for local, remote in files]))
+
+    def pullFile(self, remoteFilename, offset=None, length=None):
+        size, md5 = self.files[posixpath.normpath(remoteFilename)]
+        self._command('pullFile', size)
+        return self._content(md5)
+
+    def getFile(self, remoteFile, localFile):
+        size, md5 = self.files[posixpath.normpath(remoteFile)]
+        self._command('getFile', size)
+        with open(localFile, 'wb') as f:
+            f.write(self._content(md5))
+
+    def getDirectory(self, remoteDir, localDir, checkDir=True):
+        remoteDir = posixpath.normpath(remoteDir)
+        with self._lock:
+            files = [(path, self.files[path]) for path in self.files
+                     if path.startswith(remoteDir + '/')]
+        self._command('getDirectory', sum([size for path, (size, md5) in
+                                           files]))
+        for path, (size, md5) in files:
+            local = os.path.join(localDir, *posixpath.relpath(
+                path, remoteDir).split('/'))
+            if not os.path.isdir(os.path.dirname(local)):
+                os.makedirs(os.path.dirname(local))
+            with open(local, 'wb') as f:
+                f.write(self._content(md5))
+
+    def mkDir(self, remoteDirname):
+        self._command('mkDir')
+        with self._lock:
+            self.dirs.add(posixpath.normpath(remoteDirname))
+
+    def dirExists(self, dirpath):
+        self._command('dirExists')
+        return posixpath.normpath(dirpath) in self.dirs
+
+    def fileExists(self, filepath):
+        self._command('fileExists')
+        return posixpath.normpath(filepath) in self.files
+
+    def listFiles(self, rootdir):
+        self._command('listFiles')
+        rootdir = posixpath.normpath(rootdir)
+        with self._lock:
+            return sorted(set([posixpath.basename(p) for p in
+                               self.files.keys() + list(self.dirs)
+                               if posixpath.dirname(p) == rootdir and
+                               p != rootdir]))
+
+    def removeFile(self, filename):
+        self._command('removeFile')
+        self._remove(filename)
+
+    def removeDir(self, remoteDirname):
+        self._command('removeDir')
+        self._remove(remoteDirname)
+
+    def copyTree(self, source, destination):
+        self._command('copyTree')
+        size, md5 = self.files[posixpath.normpath(source)]
+        self._lookup(self._add(destination, size, md5))
+
+    def getInfo(self, directive=None):
+        return {'os': ['linux']}
+
+    def getTempDir(self):
+        return '/data/local/tmp'
+
+    def _glob(self, pattern, recursive=False):
+        pattern = posixpath.normpath(pattern)
+        with self._lock:
+            return sorted([p for p in self.files if
+                           fnmatch.fnmatch(p, pattern) and (
+                               recursive or
+                               p.count('/') == pattern.count('/'))])
+
+    def shell(self, cmd, outputfile, env=None, cwd=None, timeout=None,
+              root=False):
+        self._command('shell %s' % cmd[0])
+        if cmd[0] == 'unzip':
+            if not self.unzip:
+                outputfile.write('unzip: not found\n')
+                return 127
+            if len(cmd) == 1:
+                outputfile.write('Usage: unzip [-lnopq] FILE[.zip] ...\n')
+                return 1
+            archive, destination = cmd[2], cmd[4]
+            archive_md5 = self.files[posixpath.normpath(archive)][1]
+            zip_file = ZipFile(os.path.join(self.store, archive_md5))
+            entries = 0
+            for info in zip_file.infolist():
+                data = zip_file.read(info)
+                md5 = hashlib.md5(data).hexdigest()
+                if info.filename.endswith('.sqlite'):
+                    with tempfile.NamedTemporaryFile() as db:
+                        db.write(data)
+                        db.flush()
+                        self._load_database(md5, db.name)
+                self.members.setdefault(md5, (archive_md5, info.filename))
+                entries += self._add(posixpath.join(
+                    destination, info.filename), info.file_size, md5)
+            self._lookup(entries)
+            return 0
+        if cmd[0] in ['md5', 'md5sum']:
+            status = 0
+            for pattern in cmd[1:]:
+                if pattern == '/dev/null':
+                    continue
+                paths = self._glob(pattern)
+                if not paths:
+                    status = 1
+                for path in paths:
+                    outputfile.write('%s  %s\n' % (self.files[path][1], path))
+            return status
+        if cmd[:2] == ['sh', '-c']:
+            # only the copy loops of B2GPopulate.duplicate_file are
+            # understood
+            loops = re.findall(r'cd "([^"]*)" && i=(\d+) && while '
+                               r'\[ \$i -le (\d+) \]; do cat "([^"]*)" > '
+                               r'"([^"]*)" \|\|', cmd[2])
+            if not loops:
+                outputfile.write('sh: unsupported script\n')
+                return 1
+            entries = 0
+            for directory, first, last, source, duplicate in loops:
+                size, md5 = self.files[posixpath.join(directory, source)]
+                for i in range(int(first), int(last) + 1):
+                    entries += self._add(posixpath.join(
+                        directory, duplicate.replace('$i', str(i))),
+                        size, md5)
+            self._lookup(entries)
+            return 0
+        if cmd[:2] == ['ls', '-l']:
+            # as toolbox lists them, without a link count
+            directory = posixpath.normpath(cmd[2])
+            with self._lock:
+                entries = [(posixpath.basename(p), self.files[p][0])
+                           for p in self.files
+                           if posixpath.dirname(p) == directory]
+                entries.extend([(posixpath.basename(p), None)
+                                for p in self.dirs
+                                if posixpath.dirname(p) == directory and
+                                p != directory])
+            for name, size in sorted(entries):
+                if size is None:
+                    outputfile.write('drwxrwxr-x root     sdcard_rw          '
+                                     '2014-01-01 00:00 %s\n' % name)
+                else:
+                    outputfile.write('-rw-rw-r-- root     sdcard_rw %8d '
+                                     '2014-01-01 00:00 %s\n' % (size, name))
+            return 0
+        if cmd[0] == 'rm':
+            for path in cmd[1:]:
+                if not path.startswith('-'):
+                    self._remove(path)
+            return 0
+        if cmd[0] == 'getprop':
+            outputfile.write('19\n')
+            return 0
+        if cmd[0] == 'vdc':
+            outputfile.write('110 0 sdcard /sdcard 4\n'
+                             '200 0 Volumes listed.\n')
+            return 0
+        outputfile.write('%s: not found\n' % cmd[0])
+        return 127
+
+    def getProcessList(self):
+        return []
+
+
+class SimulatedMarionette(object):
+    """Marionette client answering the data layer's media queries and the
+    count script"""
+
+    CONTEXT_CHROME = 'chrome'
+    CONTEXT_CONTENT = 'content'
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.calls = Counter()
+
+    def import_script(self, js):
+        pass
+
+    def switch_to_frame(self, *args):
+        pass
+
+    def set_context(self, context):
+        pass
+
+    def execute_async_script(self, script, script_args=None, **kwargs):
+        if script == COUNT_SCRIPT:
+            self.calls['count'] += 1
+            time.sleep(self.manager.latency)
+            databases, media = script_args
+            counts = dict([(db['type'], self.manager.count_records(
+                db['name'], db['store'])) for db in databases])
+            for file_type, storage in media:
+                counts[file_type] = len(self._files(
+                    'getAll%s' % storage.capitalize()))
+            return counts
+        name = script.split('GaiaDataLayer.')[-1].split('(')[0]
+        self.calls[name] += 1
+        time.sleep(self.manager.latency)
+        return self._files(name)
+
+    def _files(self, name):
+        root = self.manager.deviceRoot
+        now = time.time()
+        paths = [path for path in self.manager._glob(
+            posixpath.join(root, '*'), recursive=True)
+            if posixpath.splitext(path)[1] in MEDIA_TYPES[name] and
+            self.manager.indexed_at.get(path, 0) <= now]
+        self.manager.scan(paths)
+        return ['/sdcard/%s' % posixpath.relpath(path, root)
+                for path in paths]
+
+
+class SimulatedDevice(object):
+    """The parts of GaiaDevice used to populate a device"""
+
+    is_android_build = True
+
+    def __init__(self, manager, stop_time=1, start_time=5):
+        self.manager = manager
+        self.file_manager = GaiaDeviceFileManager(self)
+        self.stop_time = stop_time
+        self.start_time = start_time
+
+    def stop_b2g(self, timeout=5):
+        self.manager.calls['stop_b2g'] += 1
+        time.sleep(self.stop_time)
+
+    def start_b2g(self, timeout=60):
+        self.manager.calls['start_b2g'] += 1
+        time.sleep(self.start_time)
+
+
+def run(workload, resources, latency=0.01, bandwidth=10 * 1024 * 1024,
+        stop_time=1, start_time=5, unzip=True, jobs=1, incremental=False,
+        compress=False, lookup_time=0.000001, files_per_directory=None,
+        media_count=None, index_rate=None, index_timeout=None,
+        unique_media=False):
+    """Populate a simulated device with a workload
+
+    Returns the time taken along with the adb commands, bytes and
+    Marionette calls used, and the time spent scanning media. When
+    incremental the device is populated a second time, and the results of
+    both runs are returned. If media_count is given it replaces the number
+    of music, picture and video files of the workload. Population waits up
+    to index_timeout seconds, or B2GPopulate's default, for the media to be
+    indexed, and the longest time taken to index a media type is returned.
+    If unique_media is true distinct pictures and videos are generated, and
+    the number generated per second is returned.
+    """
+    manager = SimulatedDeviceManager(latency, bandwidth, unzip, lookup_time,
+                                     index_rate)
+    marionette = SimulatedMarionette(manager)
+    device = SimulatedDevice(manager, stop_time, start_time)
+    counts = dict(('%s_count' % data_type, count) for data_type, count in
+                  WORKLOADS[workload].items())
+    if media_count is not None:
+        for data_type in ['music', 'picture', 'video']:
+            counts['%s_count' % data_type] = media_count
+    skipped = missing_resources(resources, WORKLOADS[workload].keys())
+    for data_type in skipped:
+        del counts['%s_count' % data_type]
+    results = []
+    for name in incremental and [workload, '%s*' % workload] or [workload]:
+        manager.calls.clear()
+        manager.bytes.clear()
+        manager.scan_time = 0
+        marionette.calls.clear()
+        generated = dict(resources.metrics.summary().get('variants', {}))
+        b2gpopulate = B2GPopulate(
+            marionette, jobs=jobs, resources=resources,
+            incremental=incremental, device=device, compress=compress,
+            files_per_directory=files_per_directory,
+            index_timeout=index_timeout, unique_media=unique_media)
+        start = time.time()
+        error = None
+        try:
+            b2gpopulate.populate(**counts)
+        except Exception as e:
+            error = '%s: %s' % (type(e).__name__, e)
+        variants = resources.metrics.summary().get('variants', {})
+        items = variants.get('items', 0) - generated.get('items', 0)
+        duration = variants.get('duration', 0) - generated.get('duration', 0)
+        results.append({'workload': name,
+                        'duration': time.time() - start,
+                        'commands': sum(manager.calls.values()),
+                        'bytes': sum(manager.bytes.values()),
+                        'marionette': sum(marionette.calls.values()),
+                        'scan': manager.scan_time,
+                        'indexed': max(
+                            b2gpopulate.index_latencies.values() or [None]),
+                        'generated': items / duration if duration > 0
+                        else None,
+                        'skipped': skipped,
+                        'calls': dict(manager.calls),
+                        'error': error})
+    manager.cleanup()
+    return results
+
+
+def print_results(results, verbose=False):
+    row = '%-10s %10s %10s %12s %10s %10s %11s %13s  %s'
+    print row % ('WORKLOAD', 'TIME (s)', 'COMMANDS', 'BYTES', 'SCRIPTS',
+                 'SCAN (s)', 'INDEXED (s)', 'GENERATED/S', 'RESULT')
+    for result in results:
+        print row % (result['workload'], '%.2f' % result['duration'],
+                     result['commands'], result['bytes'],
+                     result['marionette'], '%.2f' % result['scan'],
+                     '-' if result['indexed'] is None else
+                     '%.2f' % result['indexed'],
+                     '-' if result['generated'] is None else
+                     '%.0f' % result['generated'],
+                     result['error'] or 'OK')
+        if result['skipped']:
+            print '    skipped %s: packaged resources are missing' % (
+                ', '.join(result['skipped']))
+        if verbose:
+            for name, count in sorted(result['calls'].items()):
+                print '    %-20s %6d' % (name, count)
+
+
+def cli():
+    parser = argparse.ArgumentParser(
+        description='Benchmark b2gpopulate against a simulated device')
+    parser.add_argument(
+        '--workload',
+        action='append',
+        choices=sorted(WORKLOADS.keys()),
+        help='workload to run, may be repeated (default: all)')
+    parser.add_argument(
+        '--latency',
+        type=float,
+        default=10,
+        metavar='MS',
+        help='time taken by each adb command (default: %(default)s)')
+    parser.add_argument(
+        '--bandwidth',
+        type=float,
+        default=10,
+        metavar='MB/S',
+        help='transfer rate between host and device (default: %(default)s)')
+    parser.add_argument(
+        '--stop-time',
+        type=float,
+        default=1,
+        metavar='SECONDS',
+        help='time taken to stop B2G (default: %(default)s)')
+    parser.add_argument(
+        '--start-time',
+        type=float,
+        default=5,
+        metavar='SECONDS',
+        help='time taken to start B2G (default: %(default)s)')
+    parser.add_argument(
+        '--lookup-time',
+        type=float,
+        default=1,
+        metavar='US',
+        help='time taken to look through each entry of a directory for a '
+             'file (default: %(default)s)')
+    parser.add_argument(
+        '--media',
+        type=int,
+        dest='media_count',
+        metavar='FILES',
+        help='number of music, picture and video files to populate instead '
+             'of those of the workload')
+    parser.add_argument(
+        '--files-per-directory',
+        type=int,
+        metavar='FILES',
+        help='spread media over directories of at most this many files')
+    parser.add_argument(
+        '--index-rate',
+        type=float,
+        metavar='FILES/S',
+        help='rate at which B2G indexes new media, which otherwise appears '
+             'as soon as it is created')
+    parser.add_argument(
+        '--wait-for-indexing',
+        type=int,
+        dest='index_timeout',
+        metavar='TIMEOUT',
+        help='wait up to this many seconds for media to be indexed rather '
+             'than the default of b2gpopulate. The longest time taken by a '
+             'media type is reported either way')
+    parser.add_argument(
+        '--unique-media',
+        action='store_true',
+        help='push distinct pictures and videos, and report how many are '
+             'generated per second')
+    parser.add_argument(
+        '--no-unzip',
+        action='store_false',
+        dest='unzip',
+        help='simulate a device without unzip')
+    parser.add_argument(
+        '--jobs',
+        type=int,
+        default=1,
+        help='number of concurrent adb transfers of changed files when '
+             'populating incrementally (default: %(default)s)')
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help='populate incrementally, and then populate each workload '
+             'again (marked with *) to measure the skipped transfers')
+    parser.add_argument(
+        '--compress',
+        action='store_true',
+        help='push databases and directories deflated')
+    parser.add_argument(
+        '--cache-dir',
+        metavar='PATH',
+        help='keep prepared content between workloads and runs')
+    parser.add_argument(
+        '--verbose',
+        action='store_true',
+        help='list the number of each adb command used')
+    structured.commandline.add_logging_group(parser)
+
+    args = parser.parse_args()
+    structured.commandline.setup_logging(
+        'b2gpopulate', args, {'mach': sys.stderr})
+
+    resources = ResourceCache(args.cache_dir) if args.cache_dir else None
+    results = []
+    for workload in args.workload or sorted(WORKLOADS.keys()):
+        results.extend(run(workload, resources or LocalResources(),
+                           latency=args.latency / 1000.0,
+                           bandwidth=args.bandwidth * 1024 * 1024,
+                           stop_time=args.stop_time,
+                           start_time=args.start_time,
+                           unzip=args.unzip,
+                           jobs=args.jobs,
+                           incremental=args.incremental,
+                           compress=args.compress,
+                           lookup_time=args.lookup_time / 1000000.0,
+                           files_per_directory=args.files_per_directory,
+                           media_count=args.media_count,
+                           index_rate=args.index_rate,
+                           index_timeout=args.index_timeout,
+                           unique_media=args.unique_media))
+    print_results(results, args.verbose)
+    if any([r['error'] for r in results]):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,469 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Population server that keeps device sessions warm between requests
+
+Starting b2gpopulate for every population means a new Marionette session
+and device manager, and discovering the IndexedDB directory and app local
+ids of the device again. The server keeps a session for each device it has
+populated, so that test harnesses can repopulate between test cases with
+as little latency as possible. Jobs for a device are queued and run one at
+a time, while jobs for different devices run alongside each other.
+
+Each request and response is a line of JSON:
+
+    {"command": "populate", "serial": "...", "address": "localhost:2828",
+     "workload": "light", "options": {"incremental": true}, "wait": true}
+    {"command": "restore", "serial": "...", "image": "/path/to/image.zip"}
+    {"command": "status", "job": 1}
+    {"command": "wait", "job": 1, "timeout": 60}
+    {"command": "sessions"}
+    {"command": "close", "serial": "..."}
+    {"command": "shutdown"}
+
+Counts may be given instead of a workload, as in {"counts": {"call_count":
+50}}. Responses describing a job hold its status, which is one of queued,
+running, done or failed, and its error, duration and phases once it has
+finished. A request that cannot be handled is answered with an error.
+
+    python -m b2gpopulate.daemon --port 2929
+"""
+
+import argparse
+from collections import OrderedDict
+import json
+from Queue import Queue
+import socket
+import SocketServer
+import sys
+import threading
+import time
+
+from b2gpopulate import B2GPopulate
+from b2gpopulate import LocalResources
+from b2gpopulate import ResourceCache
+from b2gpopulate import WORKLOADS
+from b2gpopulate import connect
+from b2gpopulate import default_logger
+
+DEFAULT_PORT = 2929
+
+# finished jobs are forgotten once there are more than this
+MAX_FINISHED_JOBS = 100
+
+OPTIONS = ['start_timeout', 'jobs', 'incremental', 'compress',
+           'files_per_directory', 'index_timeout', 'unique_media']
+
+
+class RequestError(Exception):
+    pass
+
+
+def field(request, name, types):
+    """Return a field of a request, or None if it is missing, raising
+    RequestError unless it is one of the given types"""
+    value = request.get(name)
+    if value is not None and (not isinstance(value, types) or
+                              isinstance(value, bool)):
+        raise RequestError('Invalid value for %s' % name)
+    return value
+
+
+class Job(object):
+
+    def __init__(self, job_id, session, counts=None, image=None,
+                 options=None):
+        self.id = job_id
+        self.session = session
+        self.counts = counts
+        self.image = image
+        self.options = options or {}
+        self.status = 'queued'
+        self.error = None
+        self.warm = None
+        self.result = {}
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.done = threading.Event()
+
+    def as_dict(self):
+        job = OrderedDict([('job', self.id),
+                           ('serial', self.session.serial),
+                           ('address', self.session.address),
+                           ('status', self.status),
+                           ('error', self.error)])
+        if self.started is not None:
+            job['queued'] = round(self.started - self.submitted, 3)
+            job['warm'] = self.warm
+        if self.finished is not None:
+            job['duration'] = round(self.finished - self.started, 3)
+            job.update(self.result)
+        return job
+
+
+class Session(object):
+    """A device along with the instance that populates it
+
+    The instance is created by the first job, and reused by each job after
+    it until one fails, as the failure may have left its Marionette session
+    or device manager unusable.
+    """
+
+    def __init__(self, serial, address, factory, resources, logger):
+        self.serial = serial
+        self.address = address
+        self.factory = factory
+        self.resources = resources
+        self.logger = logger
+        self.b2gpopulate = None
+        self.jobs_run = 0
+        self.queue = Queue()
+        self.thread = threading.Thread(target=self._work)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, job):
+        self.queue.put(job)
+
+    def close(self):
+        """Drop the instance once the queued jobs have run"""
+        self.queue.put(None)
+
+    def as_dict(self):
+        return OrderedDict([('serial', self.serial),
+                            ('address', self.address),
+                            ('connected', self.b2gpopulate is not None),
+                            ('jobs_run', self.jobs_run),
+                            ('queued', self.queue.qsize())])
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.b2gpopulate = None
+                return
+            self._run(job)
+
+    def _run(self, job):
+        job.status = 'running'
+        job.started = time.time()
+        job.warm = self.b2gpopulate is not None
+        resources = self.resources()
+        options = dict(job.options)
+        options['resources'] = resources
+        try:
+            if self.b2gpopulate is None:
+                with resources.metrics.phase('connect'):
+                    self.b2gpopulate = self.factory(self.serial, self.address)
+            self.b2gpopulate.reset(**options)
+            if job.image:
+                self.b2gpopulate.restore(job.image)
+            else:
+                self.b2gpopulate.populate(**job.counts)
+            job.status = 'done'
+        except Exception as e:
+            self.logger.error('Job %d for %s failed: %s' % (
+                job.id, self.serial or self.address, e))
+            self.b2gpopulate = None
+            job.status = 'failed'
+            job.error = '%s: %s' % (type(e).__name__, e)
+        job.finished = time.time()
+        job.result = {'phases': resources.metrics.summary()}
+        if self.b2gpopulate is not None:
+            job.result['bytes_sent'] = self.b2gpopulate.bytes_sent
+            job.result['bytes_skipped'] = self.b2gpopulate.bytes_skipped
+            job.result['index_latencies'] = self.b2gpopulate.index_latencies
+        self.jobs_run += 1
+        job.done.set()
+
+
+def device_populator(serial, address):
+    """Return an instance populating a real device"""
+    return B2GPopulate(connect(address or 'localhost:2828'),
+                       device_serial=serial)
+
+
+def simulated_populator(serial, address, latency=0.01, stop_time=1,
+                        start_time=5):
+    """Return an instance populating a simulated device, as used by the
+    benchmark, which keeps its content for as long as the session"""
+    from benchmark import SimulatedDevice
+    from benchmark import SimulatedDeviceManager
+    from benchmark import SimulatedMarionette
+    manager = SimulatedDeviceManager(latency=latency)
+    return B2GPopulate(SimulatedMarionette(manager),
+                       device=SimulatedDevice(manager, stop_time, start_time))
+
+
+class Daemon(object):
+
+    def __init__(self, factory=device_populator, cache_dir=None,
+                 cache_size=1024 * 1024 * 1024):
+        self.factory = factory
+        self.logger = default_logger()
+        if cache_dir:
+            self._resources = ResourceCache(cache_dir, max_size=cache_size)
+        else:
+            self._resources = LocalResources(shared=True)
+        self.cache_dir = cache_dir
+        self.cache_size = cache_size
+        self.sessions = {}
+        self.jobs = OrderedDict()
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+    def resources(self):
+        """Return the resources of a job, which have their own metrics but
+        share the daemon's directory"""
+        if self.cache_dir:
+            return ResourceCache(self.cache_dir, max_size=self.cache_size)
+        return LocalResources(self._resources.path, shared=True)
+
+    def handle(self, request):
+        """Return the response to a request"""
+        try:
+            command = request.get('command')
+            handler = getattr(self, 'do_%s' % command, None)
+            if not isinstance(command, basestring) or handler is None:
+                raise RequestError('Unknown command: %s' % command)
+            return handler(request)
+        except RequestError as e:
+            return {'error': str(e)}
+        except Exception as e:
+            # answered rather than raised, which would leave the client
+            # without a response
+            self.logger.error('Unable to handle %r: %s' % (request, e))
+            return {'error': '%s: %s' % (type(e).__name__, e)}
+
+    def do_populate(self, request):
+        if 'workload' in request:
+            workload = field(request, 'workload', basestring)
+            if workload not in WORKLOADS:
+                raise RequestError('Unknown workload: %s' % workload)
+            counts = dict(('%s_count' % data_type, count) for
+                          data_type, count in WORKLOADS[workload].items())
+        else:
+            counts = field(request, 'counts', dict) or {}
+            valid = ['%s_count' % data_type for data_type in
+                     WORKLOADS['empty']]
+            for key in counts:
+                if key not in valid:
+                    raise RequestError('Unknown count: %s' % key)
+                count = field(counts, key, (int, long))
+                if count is not None and count < 0:
+                    raise RequestError('Invalid value for %s' % key)
+            if not any([count is not None for count in counts.values()]):
+                raise RequestError('Must specify at least one item to '
+                                   'populate')
+        return self._submit(request, counts=dict(counts))
+
+    def do_restore(self, request):
+        image = field(request, 'image', basestring)
+        if not image:
+            raise RequestError('Please specify an image to restore')
+        return self._submit(request, image=image)
+
+    def do_status(self, request):
+        return self._job(request).as_dict()
+
+    def do_wait(self, request):
+        job = self._job(request)
+        timeout = field(request, 'timeout', (int, long, float))
+        if timeout is not None and timeout < 0:
+            raise RequestError('Invalid value for timeout')
+        job.done.wait(timeout)
+        return job.as_dict()
+
+    def do_sessions(self, request):
+        with self._lock:
+            sessions = self.sessions.values()
+        return {'sessions': [session.as_dict() for session in sessions]}
+
+    def do_close(self, request):
+        with self._lock:
+            session = self.sessions.pop(self._key(request), None)
+        if session is None:
+            raise RequestError('There is no session for %s' % (
+                request.get('serial') or request.get('address')))
+        session.close()
+        return session.as_dict()
+
+    def do_shutdown(self, request):
+        self.close()
+        return {'shutdown': True}
+
+    def close(self):
+        with self._lock:
+            sessions = self.sessions.values()
+            self.sessions = {}
+        for session in sessions:
+            session.close()
+        for session in sessions:
+            session.thread.join()
+        self._resources.cleanup()
+
+    def _key(self, request):
+        return (field(request, 'serial', basestring),
+                field(request, 'address', basestring))
+
+    def _job(self, request):
+        job_id = field(request, 'job', (int, long))
+        with self._lock:
+            job = self.jobs.get(job_id)
+        if job is None:
+            raise RequestError('Unknown job: %s' % job_id)
+        return job
+
+    def _submit(self, request, **job):
+        options = field(request, 'options', dict) or {}
+        for option in options:
+            if option not in OPTIONS:
+                raise RequestError('Unknown option: %s' % option)
+        with self._lock:
+            key = self._key(request)
+            session = self.sessions.get(key)
+            if session is None:
+                session = self.sessions[key] = Session(
+                    key[0], key[1], self.factory, self.resources, self.logger)
+            job = Job(self._next_id, session, options=options, **job)
+            self._next_id += 1
+            self.jobs[job.id] = job
+            finished = [j for j in self.jobs.values() if j.done.is_set()]
+            for old in finished[:len(finished) - MAX_FINISHED_JOBS]:
+                del self.jobs[old.id]
+        session.submit(job)
+        if request.get('wait'):
+            job.done.wait()
+        return job.as_dict()
+
+
+class RequestHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError('not an object')
+            except ValueError as e:
+                response = {'error': 'Invalid request: %s' % e}
+            else:
+                response = self.server.daemon.handle(request)
+            self.wfile.write('%s\n' % json.dumps(response))
+            self.wfile.flush()
+            if response.get('shutdown'):
+                # shutdown waits for serve_forever, which runs elsewhere
+                threading.Thread(target=self.server.shutdown).start()
+                return
+
+
+class Server(SocketServer.ThreadingTCPServer):
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, daemon):
+        SocketServer.ThreadingTCPServer.__init__(self, address,
+                                                 RequestHandler)
+        self.daemon = daemon
+
+
+def request(address, **message):
+    """Send a request to a running daemon and return its response"""
+    host, port = address.split(':')
+    connection = socket.create_connection((host, int(port)))
+    try:
+        connection.sendall('%s\n' % json.dumps(message))
+        response = connection.makefile().readline()
+    finally:
+        connection.close()
+    if not response:
+        raise RequestError('No response from %s' % address)
+    return json.loads(response)
+
+
+def cli():
+    from mozlog.structured import commandline
+
+    parser = argparse.ArgumentParser(
+        description='Keep device sessions warm and populate devices on '
+                    'request')
+    parser.add_argument(
+        '--host',
+        default='127.0.0.1',
+        help='address to listen on (default: %(default)s)')
+    parser.add_argument(
+        '--port',
+        type=int,
+        default=DEFAULT_PORT,
+        help='port to listen on (default: %(default)s)')
+    parser.add_argument(
+        '--cache-dir',
+        metavar='DIR',
+        help='directory to keep extracted and generated content in between '
+             'runs of the daemon')
+    parser.add_argument(
+        '--cache-size',
+        type=int,
+        default=1024,
+        metavar='MB',
+        help='maximum size of the cache in megabytes (default: %(default)s)')
+    parser.add_argument(
+        '--simulate',
+        action='store_true',
+        help='populate simulated devices, as used by the benchmark, for '
+             'testing clients of the daemon')
+    parser.add_argument(
+        '--latency',
+        type=float,
+        default=10,
+        metavar='MS',
+        help='time taken by each adb command of a simulated device '
+             '(default: %(default)s)')
+    parser.add_argument(
+        '--stop-time',
+        type=float,
+        default=1,
+        metavar='SECONDS',
+        help='time taken to stop B2G on a simulated device '
+             '(default: %(default)s)')
+    parser.add_argument(
+        '--start-time',
+        type=float,
+        default=5,
+        metavar='SECONDS',
+        help='time taken to start B2G on a simulated device '
+             '(default: %(default)s)')
+    commandline.add_logging_group(parser)
+
+    args = parser.parse_args()
+    commandline.setup_logging(
+        'b2gpopulate', args, {'mach': sys.stdout})
+
+    factory = device_populator
+    if args.simulate:
+        def factory(serial, address):
+            return simulated_populator(serial, address,
+                                       latency=args.latency / 1000.0,
+                                       stop_time=args.stop_time,
+                                       start_time=args.start_time)
+
+    daemon = Daemon(factory, cache_dir=args.cache_dir,
+                    cache_size=args.cache_size * 1024 * 1024)
+    server = Server((args.host, args.port), daemon)
+    daemon.logger.info('Listening on %s:%d' % server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        daemon.close()
+
+
+if __name__ == '__main__':
+    cli()
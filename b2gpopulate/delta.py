@@ -0,0 +1,244 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Compact storage of the prebuilt databases of every workload size
+
+A store holds the smallest database in full, and each larger one as a delta
+against the next smaller one. A delta is a list of copies from the smaller
+database along with the bytes that could not be copied, which are deflated
+together. Each database is rebuilt byte for byte on demand and checked
+against the CRC-32 it was stored with.
+
+A store is built from the zip of databases it replaces, and every database
+is rebuilt and compared with the zip before the store is written:
+
+    python -m b2gpopulate.delta b2gpopulate/resources/smsDb.zip
+"""
+
+import argparse
+import json
+import os
+import struct
+import sys
+import zlib
+from zipfile import ZipFile
+
+MAGIC = 'B2GDELTA'
+VERSION = 1
+
+# shortest run of bytes copied from the base database, which is also the
+# alignment of the runs looked up in it
+BLOCK_SIZE = 32
+
+OP = struct.Struct('>III')
+
+
+class StoreError(Exception):
+    pass
+
+
+class StoreInfo(object):
+    """The stored size and CRC-32 of a database, as in a zip's ZipInfo"""
+
+    def __init__(self, filename, file_size, CRC):
+        self.filename = filename
+        self.file_size = file_size
+        self.CRC = CRC
+
+
+def encode(base, target):
+    """Return the copies from base and the literal bytes that make target
+
+    Each copy is a tuple of the number of literal bytes that precede it,
+    and the offset and length of the bytes copied from base.
+    """
+    blocks = {}
+    for offset in range(0, len(base) - BLOCK_SIZE + 1, BLOCK_SIZE):
+        blocks.setdefault(base[offset:offset + BLOCK_SIZE], offset)
+    copies = []
+    literals = []
+    literal_start = pos = 0
+    end = len(target) - BLOCK_SIZE
+    while pos <= end:
+        offset = blocks.get(target[pos:pos + BLOCK_SIZE])
+        if offset is None:
+            pos += 1
+            continue
+        # extend the copy backwards over literal bytes, and then forwards
+        start = pos
+        while start > literal_start and offset > 0 and \
+                target[start - 1] == base[offset - 1]:
+            start -= 1
+            offset -= 1
+        pos += BLOCK_SIZE
+        while pos < len(target) and offset + pos - start < len(base) and \
+                target[pos] == base[offset + pos - start]:
+            pos += 1
+        literals.append(target[literal_start:start])
+        copies.append((start - literal_start, offset, pos - start))
+        literal_start = pos
+    literals.append(target[literal_start:])
+    return copies, ''.join(literals)
+
+
+def decode(base, copies, literals):
+    """Return the bytes made by applying copies and literals to base"""
+    parts = []
+    pos = 0
+    for literal_size, offset, size in copies:
+        parts.append(literals[pos:pos + literal_size])
+        parts.append(base[offset:offset + size])
+        pos += literal_size
+    parts.append(literals[pos:])
+    return ''.join(parts)
+
+
+class Store(object):
+    """A store of databases, read like a zip of the same databases"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise StoreError('%s is not a database store' % path)
+            size, = struct.unpack('>I', f.read(4))
+            index = json.loads(f.read(size))
+        if index['version'] != VERSION:
+            raise StoreError('Unable to read version %d of %s' % (
+                index['version'], path))
+        self._data_offset = len(MAGIC) + 4 + size
+        self._members = index['members']
+        self._by_name = dict([(m['name'], m) for m in self._members])
+
+    def namelist(self):
+        return [member['name'] for member in self._members]
+
+    def infolist(self):
+        return [StoreInfo(m['name'], m['size'], m['crc'])
+                for m in self._members]
+
+    def getinfo(self, name):
+        member = self._member(name)
+        return StoreInfo(member['name'], member['size'], member['crc'])
+
+    def read(self, name):
+        """Rebuild the named database from the smallest one upwards"""
+        chain = [self._member(name)]
+        while chain[0]['base'] is not None:
+            chain.insert(0, self._member(chain[0]['base']))
+        data = ''
+        with open(self.path, 'rb') as f:
+            for member in chain:
+                f.seek(self._data_offset + member['offset'])
+                payload = zlib.decompress(f.read(member['length']))
+                count, = struct.unpack('>I', payload[:4])
+                end = 4 + count * OP.size
+                values = struct.unpack('>%dI' % (count * 3), payload[4:end])
+                data = decode(data, zip(*[iter(values)] * 3), payload[end:])
+        if len(data) != member['size'] or \
+                zlib.crc32(data) & 0xffffffff != member['crc']:
+            raise StoreError('%s in %s is corrupt' % (name, self.path))
+        return data
+
+    def _member(self, name):
+        try:
+            return self._by_name[name]
+        except KeyError:
+            raise KeyError('There is no item named %r in %s' % (
+                name, self.path))
+
+
+def build(zip_path, path):
+    """Write a store of the databases in a zip, ordered by size
+
+    Every database is rebuilt from the store and compared with the zip
+    before the store is moved into place, so a store that exists is known
+    to reproduce the zip exactly.
+    """
+    archive = ZipFile(zip_path)
+    infos = sorted([info for info in archive.infolist()
+                    if not info.filename.endswith('/')],
+                   key=lambda info: (info.file_size, info.filename))
+    members = []
+    payloads = []
+    offset = 0
+    base = base_name = None
+    for info in infos:
+        data = archive.read(info.filename)
+        copies, literals = encode(base or '', data)
+        payload = zlib.compress(''.join(
+            [struct.pack('>I', len(copies))] +
+            [OP.pack(*copy) for copy in copies] + [literals]), 9)
+        members.append({'name': info.filename,
+                        'base': base_name,
+                        'size': info.file_size,
+                        'crc': info.CRC,
+                        'offset': offset,
+                        'length': len(payload)})
+        payloads.append(payload)
+        offset += len(payload)
+        base, base_name = data, info.filename
+
+    index = json.dumps({'version': VERSION, 'members': members},
+                       sort_keys=True)
+    temp = '%s.tmp' % path
+    with open(temp, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('>I', len(index)))
+        f.write(index)
+        for payload in payloads:
+            f.write(payload)
+    try:
+        verify(temp, zip_path)
+    except Exception:
+        os.remove(temp)
+        raise
+    os.rename(temp, path)
+
+
+def verify(path, zip_path):
+    """Raise StoreError unless a store holds exactly the databases of a
+    zip"""
+    store = Store(path)
+    archive = ZipFile(zip_path)
+    names = sorted([name for name in archive.namelist()
+                    if not name.endswith('/')])
+    if sorted(store.namelist()) != names:
+        raise StoreError('%s does not hold the databases of %s' % (
+            path, zip_path))
+    for name in names:
+        if store.read(name) != archive.read(name):
+            raise StoreError('%s in %s differs from %s' % (
+                name, path, zip_path))
+
+
+def cli():
+    parser = argparse.ArgumentParser(
+        description='Build stores of the databases in prebuilt zips')
+    parser.add_argument(
+        'zips',
+        nargs='+',
+        metavar='ZIP',
+        help='zip of databases, stored alongside as .delta')
+    parser.add_argument(
+        '--verify',
+        action='store_true',
+        help='check existing stores against their zips instead')
+    args = parser.parse_args()
+
+    for zip_path in args.zips:
+        path = '%s.delta' % os.path.splitext(zip_path)[0]
+        try:
+            if args.verify:
+                verify(path, zip_path)
+            else:
+                build(zip_path, path)
+        except (StoreError, IOError, OSError) as e:
+            sys.exit('%s: %s' % (zip_path, e))
+        print '%s: %d bytes, %d as a zip' % (
+            path, os.path.getsize(path), os.path.getsize(zip_path))
+
+
+if __name__ == '__main__':
+    cli()
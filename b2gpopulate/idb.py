@@ -0,0 +1,648 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Reading and writing Gecko IndexedDB sqlite files
+
+Records are stored as snappy compressed structured clone buffers and keys
+use the IndexedDB key encoding. This module implements enough of both to
+decode the prebuilt databases and synthesize new ones of any size from
+them.
+"""
+
+from collections import OrderedDict
+import copy
+import shutil
+import sqlite3
+import struct
+
+try:
+    import snappy
+except ImportError:
+    snappy = None
+
+# structured clone tags
+SCTAG_NULL = 0xFFFF0000
+SCTAG_UNDEFINED = 0xFFFF0001
+SCTAG_BOOLEAN = 0xFFFF0002
+SCTAG_INT32 = 0xFFFF0003
+SCTAG_STRING = 0xFFFF0004
+SCTAG_DATE_OBJECT = 0xFFFF0005
+SCTAG_ARRAY_OBJECT = 0xFFFF0007
+SCTAG_OBJECT_OBJECT = 0xFFFF0008
+SCTAG_BACK_REFERENCE_OBJECT = 0xFFFF000D
+SCTAG_FLOAT_MAX = 0xFFF00000
+SCTAG_DOM_BLOB = 0xFFFF8001
+SCTAG_DOM_FILE = 0xFFFF8002
+
+# key types
+KEY_TERMINATOR = 0
+KEY_FLOAT = 1
+KEY_DATE = 2
+KEY_STRING = 3
+KEY_ARRAY = 4
+KEY_MAX_ARRAY_COLLAPSE = 3
+
+
+class Undefined(object):
+    """The JavaScript undefined value"""
+
+    def __repr__(self):
+        return 'undefined'
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+undefined = Undefined()
+
+
+class Date(object):
+
+    def __init__(self, time):
+        self.time = time
+
+    def __eq__(self, other):
+        return isinstance(other, Date) and self.time == other.time
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Date(%r)' % self.time
+
+
+class Blob(object):
+    """Reference to a file stored alongside an IndexedDB database"""
+
+    def __init__(self, index, size, content_type, name=None,
+                 last_modified=None):
+        self.index = index
+        self.size = size
+        self.content_type = content_type
+        self.name = name
+        self.last_modified = last_modified
+
+    def __eq__(self, other):
+        return isinstance(other, Blob) and self.__dict__ == other.__dict__
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Blob(%r, %r, %r)' % (self.index, self.size, self.content_type)
+
+
+def snappy_decompress(data):
+    length, pos = _read_varint(data, 0)
+    out = bytearray()
+    while pos < len(data):
+        tag = ord(data[pos])
+        pos += 1
+        if tag & 3 == 0:
+            size = tag >> 2
+            if size >= 60:
+                count = size - 59
+                size = 0
+                for i in range(count):
+                    size |= ord(data[pos + i]) << (8 * i)
+                pos += count
+            size += 1
+            out += data[pos:pos + size]
+            pos += size
+            continue
+        if tag & 3 == 1:
+            size = ((tag >> 2) & 7) + 4
+            offset = ((tag >> 5) << 8) | ord(data[pos])
+            pos += 1
+        elif tag & 3 == 2:
+            size = (tag >> 2) + 1
+            offset = struct.unpack('<H', data[pos:pos + 2])[0]
+            pos += 2
+        else:
+            size = (tag >> 2) + 1
+            offset = struct.unpack('<I', data[pos:pos + 4])[0]
+            pos += 4
+        start = len(out) - offset
+        if offset >= size:
+            out += out[start:start + size]
+        else:
+            for i in range(size):
+                out.append(out[start + i])
+    if not len(out) == length:
+        raise ValueError('Expected %d bytes but decompressed %d' % (
+            length, len(out)))
+    return str(out)
+
+
+def snappy_compress(data):
+    if snappy is not None:
+        return snappy.compress(data)
+    # without python-snappy emit a stream of literals, which every snappy
+    # decoder accepts and costs nothing to produce
+    out = [_varint(len(data))]
+    for start in range(0, len(data), 65536):
+        chunk = data[start:start + 65536]
+        size = len(chunk) - 1
+        if size < 60:
+            out.append(chr(size << 2))
+        elif size < 256:
+            out.append(chr(60 << 2) + chr(size))
+        else:
+            out.append(chr(61 << 2) + struct.pack('<H', size))
+        out.append(chunk)
+    return ''.join(out)
+
+
+def _varint(value):
+    out = []
+    while value >= 0x80:
+        out.append(chr((value & 0x7F) | 0x80))
+        value >>= 7
+    out.append(chr(value))
+    return ''.join(out)
+
+
+def _read_varint(data, pos):
+    value = shift = 0
+    while True:
+        byte = ord(data[pos])
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+
+class _CloneReader(object):
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+        self.objects = []
+
+    def pair(self):
+        data, tag = struct.unpack('<II', self.data[self.pos:self.pos + 8])
+        self.pos += 8
+        return tag, data
+
+    def peek_tag(self):
+        return struct.unpack('<I', self.data[self.pos + 4:self.pos + 8])[0]
+
+    def bytes(self, size):
+        value = self.data[self.pos:self.pos + size]
+        self.pos += (size + 7) & ~7
+        return value
+
+    def uint64(self):
+        return struct.unpack('<Q', self.bytes(8))[0]
+
+    def string(self, length):
+        return self.bytes(length * 2).decode('utf-16-le')
+
+    def read(self):
+        tag, data = self.pair()
+        if tag < SCTAG_FLOAT_MAX:
+            self.pos -= 8
+            return struct.unpack('<d', self.bytes(8))[0]
+        if tag == SCTAG_NULL:
+            return None
+        if tag == SCTAG_UNDEFINED:
+            return undefined
+        if tag == SCTAG_BOOLEAN:
+            return bool(data)
+        if tag == SCTAG_INT32:
+            return struct.unpack('<i', struct.pack('<I', data))[0]
+        if tag == SCTAG_STRING:
+            return self.string(data)
+        if tag == SCTAG_DATE_OBJECT:
+            value = Date(struct.unpack('<d', self.bytes(8))[0])
+            self.objects.append(value)
+            return value
+        if tag == SCTAG_BACK_REFERENCE_OBJECT:
+            return self.objects[data]
+        if tag in (SCTAG_DOM_BLOB, SCTAG_DOM_FILE):
+            size = self.uint64()
+            content_type = self.bytes(
+                struct.unpack('<I', self.bytes(4))[0]).decode('utf-8')
+            value = Blob(data, size, content_type)
+            if tag == SCTAG_DOM_FILE:
+                value.last_modified = self.uint64()
+                value.name = self.bytes(
+                    struct.unpack('<I', self.bytes(4))[0]).decode('utf-8')
+            return value
+        if tag == SCTAG_ARRAY_OBJECT:
+            value = []
+        elif tag == SCTAG_OBJECT_OBJECT:
+            value = OrderedDict()
+        else:
+            raise ValueError('Unsupported structured clone tag 0x%08x' % tag)
+        self.objects.append(value)
+        while not self.peek_tag() == SCTAG_NULL:
+            key = self.read()
+            item = self.read()
+            if isinstance(value, list):
+                value.extend([undefined] * (key + 1 - len(value)))
+                value[key] = item
+            else:
+                value[key] = item
+        self.pair()
+        return value
+
+
+class _CloneWriter(object):
+
+    def __init__(self):
+        self.out = []
+        self.objects = {}
+
+    def pair(self, tag, data=0):
+        self.out.append(struct.pack('<II', data, tag))
+
+    def bytes(self, value):
+        self.out.append(value + '\0' * (-len(value) & 7))
+
+    def string(self, value):
+        self.pair(SCTAG_STRING, len(value))
+        self.bytes(value.encode('utf-16-le'))
+
+    def write(self, value):
+        if value is None:
+            self.pair(SCTAG_NULL)
+        elif value is undefined:
+            self.pair(SCTAG_UNDEFINED)
+        elif isinstance(value, bool):
+            self.pair(SCTAG_BOOLEAN, int(value))
+        elif isinstance(value, (int, long)) and -2 ** 31 <= value < 2 ** 31:
+            self.pair(SCTAG_INT32, value & 0xFFFFFFFF)
+        elif isinstance(value, (int, long, float)):
+            self.out.append(struct.pack('<d', value))
+        elif isinstance(value, basestring):
+            self.string(unicode(value))
+        elif id(value) in self.objects:
+            self.pair(SCTAG_BACK_REFERENCE_OBJECT, self.objects[id(value)])
+        elif isinstance(value, Blob):
+            tag = SCTAG_DOM_BLOB if value.name is None else SCTAG_DOM_FILE
+            self.pair(tag, value.index)
+            self.bytes(struct.pack('<Q', value.size))
+            content_type = value.content_type.encode('utf-8')
+            self.bytes(struct.pack('<I', len(content_type)))
+            self.bytes(content_type)
+            if value.name is not None:
+                name = value.name.encode('utf-8')
+                self.bytes(struct.pack('<Q', value.last_modified))
+                self.bytes(struct.pack('<I', len(name)))
+                self.bytes(name)
+        else:
+            self.objects[id(value)] = len(self.objects)
+            if isinstance(value, Date):
+                self.pair(SCTAG_DATE_OBJECT)
+                self.out.append(struct.pack('<d', value.time))
+            elif isinstance(value, list):
+                # this version of the format does not record array lengths
+                self.pair(SCTAG_ARRAY_OBJECT)
+                for index, item in enumerate(value):
+                    self.pair(SCTAG_INT32, index)
+                    self.write(item)
+                self.pair(SCTAG_NULL)
+            elif isinstance(value, dict):
+                self.pair(SCTAG_OBJECT_OBJECT)
+                for key, item in value.items():
+                    if isinstance(key, (int, long)):
+                        self.pair(SCTAG_INT32, key & 0xFFFFFFFF)
+                    else:
+                        self.string(unicode(key))
+                    self.write(item)
+                self.pair(SCTAG_NULL)
+            else:
+                raise TypeError('Unable to clone %r' % value)
+
+
+def decode_value(data):
+    """Decode the data column of an object_data row"""
+    return _CloneReader(snappy_decompress(data)).read()
+
+
+def encode_value(value):
+    """Encode a value for the data column of an object_data row"""
+    writer = _CloneWriter()
+    writer.write(value)
+    return snappy_compress(''.join(writer.out))
+
+
+def encode_key(value):
+    """Encode a valid IndexedDB key, trimming trailing zero bytes"""
+    out = bytearray()
+    _encode_key(value, 0, out)
+    return str(out).rstrip('\0')
+
+
+def _encode_key(value, type_offset, out):
+    if isinstance(value, basestring):
+        out.append(KEY_STRING + type_offset)
+        for c in unicode(value):
+            c = ord(c)
+            if c <= 0x7E:
+                out.append(c + 1)
+            elif c <= 0x3FFF + 0x7F:
+                c -= 0x7F
+                out.append(c >> 8 | 0x80)
+                out.append(c & 0xFF)
+            else:
+                c = (c << 6) | 0x00C00000
+                out.extend([(c >> 16) & 0xFF, (c >> 8) & 0xFF, c & 0xFF])
+        out.append(KEY_TERMINATOR)
+    elif isinstance(value, (Date, int, long, float)) and not isinstance(
+            value, bool):
+        if isinstance(value, Date):
+            out.append(KEY_DATE + type_offset)
+            value = value.time
+        else:
+            out.append(KEY_FLOAT + type_offset)
+        bits = struct.unpack('>Q', struct.pack('>d', value))[0]
+        if bits & 0x8000000000000000:
+            bits = -bits & 0xFFFFFFFFFFFFFFFF
+        else:
+            bits |= 0x8000000000000000
+        out.extend(struct.pack('>Q', bits))
+    elif isinstance(value, list):
+        if type_offset == KEY_ARRAY * KEY_MAX_ARRAY_COLLAPSE:
+            out.append(type_offset)
+            type_offset = 0
+        type_offset += KEY_ARRAY
+        for item in value:
+            _encode_key(item, type_offset, out)
+            type_offset = 0
+        out.append(KEY_TERMINATOR + type_offset)
+    else:
+        raise ValueError('%r is not a valid key' % (value, ))
+
+
+def is_valid_key(value):
+    if isinstance(value, bool):
+        return False
+    if isinstance(value, (basestring, Date, int, long)):
+        return True
+    if isinstance(value, float):
+        return value == value
+    if isinstance(value, list):
+        return all(is_valid_key(item) for item in value)
+    return False
+
+
+def get_key_path(value, key_path):
+    for part in key_path.split('.') if key_path else []:
+        if not isinstance(value, dict) or part not in value:
+            return undefined
+        value = value[part]
+    return value
+
+
+def set_key_path(value, key_path, item):
+    parts = key_path.split('.')
+    for part in parts[:-1]:
+        value = value[part]
+    value[parts[-1]] = item
+
+
+def index_keys(value, key_path, multi_entry):
+    """Return the encoded index keys for a value"""
+    value = get_key_path(value, key_path)
+    if multi_entry and isinstance(value, list):
+        keys = set(encode_key(item) for item in value if is_valid_key(item))
+        return sorted(keys)
+    if is_valid_key(value):
+        return [encode_key(value)]
+    return []
+
+
+def _unique(value, copy_number, span, descending=False):
+    """Derive a distinct key for a copy of a template record
+
+    Each key in an array is made distinct, which covers the entries of a
+    multiEntry index too.
+    """
+    if isinstance(value, list):
+        return [_unique(item, copy_number, span, descending)
+                if is_valid_key(item) else item for item in value]
+    if isinstance(value, basestring):
+        return u'%s-%d' % (value, copy_number)
+    if isinstance(value, Date):
+        return Date(_unique(value.time, copy_number, span, descending))
+    offset = copy_number * span
+    return value - offset if descending else value + offset
+
+
+def _span(values):
+    numbers = list(_numbers(values))
+    return numbers and max(numbers) - min(numbers) + 1 or 1
+
+
+def _numbers(values):
+    for value in values:
+        if isinstance(value, list):
+            for number in _numbers(value):
+                yield number
+        elif isinstance(value, Date):
+            yield value.time
+        elif isinstance(value, (int, long, float)) and \
+                not isinstance(value, bool):
+            yield value
+
+
+def database_name(path):
+    db = sqlite3.connect(path)
+    try:
+        return db.execute('SELECT name FROM database').fetchone()[0]
+    finally:
+        db.close()
+
+
+def count_records(path, store_name):
+    db = sqlite3.connect(path)
+    try:
+        return db.execute(
+            'SELECT COUNT(*) FROM object_data JOIN object_store '
+            'ON object_store.id = object_data.object_store_id '
+            'WHERE object_store.name = ?', (store_name, )).fetchone()[0]
+    finally:
+        db.close()
+
+
+def generate(template, destination, store_name, count, descending=False,
+             batch_size=1000):
+    """Write a copy of a template database with count records in a store
+
+    The records already in the store are used as templates and repeated
+    until count records have been written. Every copy after the first gets
+    distinct primary and unique index keys, offset by the range of the
+    template's keys (towards lower keys if descending). Records of other
+    object stores are left as they are. Rows are streamed in transactions of
+    batch_size, so memory use is bounded by the size of the template.
+    """
+    shutil.copy(template, destination)
+    db = sqlite3.connect(destination)
+    db.text_factory = str
+    # the triggers on object_data maintain file reference counts through
+    # this function, so collect the changes and apply them per batch
+    refcounts = {}
+    db.create_function('update_refcount', 2, lambda old, new: _count_refs(
+        refcounts, old, new))
+    try:
+        store_id, key_path = db.execute(
+            'SELECT id, key_path FROM object_store WHERE name = ?',
+            (store_name, )).fetchone()
+        indexes = db.execute(
+            'SELECT id, key_path, unique_index, multientry '
+            'FROM object_store_index WHERE object_store_id = ?',
+            (store_id, )).fetchall()
+        templates = [(decode_key(str(key)), decode_value(str(data)), file_ids)
+                     for key, data, file_ids in db.execute(
+                         'SELECT key_value, data, file_ids FROM object_data '
+                         'WHERE object_store_id = ? ORDER BY id',
+                         (store_id, ))]
+        if count and not templates:
+            raise ValueError('No %s records to use as templates in %s' % (
+                store_name, template))
+
+        index_ids = [str(i[0]) for i in indexes]
+        if index_ids:
+            for table in ['index_data', 'unique_index_data']:
+                db.execute('DELETE FROM %s WHERE index_id IN (%s)' % (
+                    table, ','.join(index_ids)))
+        db.execute('DELETE FROM object_data WHERE object_store_id = ?',
+                   (store_id, ))
+
+        key_span = _span([t[0] for t in templates])
+        unique_spans = dict(
+            (index_id, _span([get_key_path(t[1], path) for t in templates]))
+            for index_id, path, unique, multi_entry in indexes if unique)
+        next_id = (db.execute(
+            'SELECT MAX(id) FROM object_data').fetchone()[0] or 0) + 1
+
+        def rows():
+            for i in xrange(count):
+                key, value, file_ids = templates[i % len(templates)]
+                copy_number = i // len(templates)
+                if copy_number:
+                    value = copy.deepcopy(value)
+                    key = _unique(key, copy_number, key_span, descending)
+                    if key_path:
+                        set_key_path(value, key_path, key)
+                    for index_id, path, unique, multi_entry in indexes:
+                        item = get_key_path(value, path)
+                        if unique and is_valid_key(item):
+                            set_key_path(value, path, _unique(
+                                item, copy_number, unique_spans[index_id],
+                                descending))
+                yield key, value, file_ids
+
+        object_rows = []
+        index_rows = []
+        unique_rows = []
+        max_key = None
+        for key, value, file_ids in rows():
+            encoded_key = encode_key(key)
+            object_rows.append((next_id, store_id, buffer(encoded_key),
+                                file_ids, buffer(encode_value(value))))
+            for index_id, path, unique, multi_entry in indexes:
+                target = unique_rows if unique else index_rows
+                for index_key in index_keys(value, path, multi_entry):
+                    target.append((index_id, buffer(index_key),
+                                   buffer(encoded_key), next_id))
+            if isinstance(key, (int, long, float)):
+                max_key = max(max_key, key)
+            next_id += 1
+            if len(object_rows) >= batch_size:
+                _insert(db, object_rows, index_rows, unique_rows, refcounts)
+        _insert(db, object_rows, index_rows, unique_rows, refcounts)
+
+        auto_increment = db.execute(
+            'SELECT auto_increment FROM object_store WHERE id = ?',
+            (store_id, )).fetchone()[0]
+        if auto_increment and max_key is not None:
+            db.execute('UPDATE object_store SET auto_increment = ? '
+                       'WHERE id = ?', (int(max_key) + 1, store_id))
+            db.commit()
+        db.execute('VACUUM')
+    finally:
+        db.close()
+
+
+def _insert(db, object_rows, index_rows, unique_rows, refcounts):
+    with db:
+        db.executemany(
+            'INSERT INTO object_data '
+            '(id, object_store_id, key_value, file_ids, data) '
+            'VALUES (?, ?, ?, ?, ?)', object_rows)
+        db.executemany(
+            'INSERT OR IGNORE INTO index_data '
+            '(index_id, value, object_data_key, object_data_id) '
+            'VALUES (?, ?, ?, ?)', index_rows)
+        db.executemany(
+            'INSERT INTO unique_index_data '
+            '(index_id, value, object_data_key, object_data_id) '
+            'VALUES (?, ?, ?, ?)', unique_rows)
+        db.executemany(
+            'UPDATE file SET refcount = refcount + ? WHERE id = ?',
+            [(delta, file_id) for file_id, delta in refcounts.items()])
+    del object_rows[:], index_rows[:], unique_rows[:]
+    refcounts.clear()
+
+
+def _count_refs(refcounts, old, new):
+    for file_ids, delta in [(old, -1), (new, 1)]:
+        for file_id in (file_ids or '').split():
+            file_id = abs(int(file_id))
+            refcounts[file_id] = refcounts.get(file_id, 0) + delta
+
+
+def decode_key(data):
+    """Decode an encoded IndexedDB key"""
+    value, pos = _decode_key(bytearray(data) + bytearray(9), 0, 0)
+    return value
+
+
+def _decode_key(data, pos, type_offset):
+    if data[pos] - type_offset >= KEY_ARRAY:
+        type_offset += KEY_ARRAY
+        if type_offset == KEY_ARRAY * KEY_MAX_ARRAY_COLLAPSE:
+            pos += 1
+            type_offset = 0
+        value = []
+        while not data[pos] - type_offset == KEY_TERMINATOR:
+            item, pos = _decode_key(data, pos, type_offset)
+            type_offset = 0
+            value.append(item)
+        return value, pos + 1
+    key_type = data[pos]
+    key_type -= type_offset
+    if key_type == KEY_STRING:
+        pos += 1
+        chars = []
+        while not data[pos] == KEY_TERMINATOR:
+            c = data[pos]
+            if not c & 0x80:
+                chars.append(unichr(c - 1))
+                pos += 1
+            elif not c & 0x40:
+                chars.append(unichr(((c & 0x7F) << 8 | data[pos + 1]) + 0x7F))
+                pos += 2
+            else:
+                c = (c << 16 | data[pos + 1] << 8 | data[pos + 2]) >> 6
+                chars.append(unichr(c & 0xFFFF))
+                pos += 3
+        return u''.join(chars), pos + 1
+    if key_type in (KEY_FLOAT, KEY_DATE):
+        bits = struct.unpack('>Q', str(data[pos + 1:pos + 9]))[0]
+        if bits & 0x8000000000000000:
+            bits &= 0x7FFFFFFFFFFFFFFF
+        else:
+            bits = -bits & 0xFFFFFFFFFFFFFFFF
+        value = struct.unpack('>d', struct.pack('>Q', bits))[0]
+        if value == int(value) and abs(value) < 2 ** 53:
+            value = int(value)
+        if key_type == KEY_DATE:
+            value = Date(value)
+        return value, pos + 9
+    raise ValueError('Unsupported key type %d' % key_type)
@@ -0,0 +1,91 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Progress of a population, so that an interrupted run can be resumed
+
+A journal is a file of JSON lines. The first line identifies the device
+and the counts being populated, and each following line names a step that
+completed. Every line is synced to disk as it is written, so a run that
+dies loses at most the step it was in the middle of.
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+
+DEFAULT_DIR = os.path.join(os.path.expanduser('~'), '.b2gpopulate',
+                           'journals')
+
+
+def journal_path(directory, serial, counts):
+    """Return the journal of a device populated with the given counts"""
+    key = hashlib.md5(json.dumps(counts, sort_keys=True)).hexdigest()[:8]
+    return os.path.join(directory, '%s-%s.journal' % (
+        re.sub(r'[^\w.-]', '_', serial or 'default'), key))
+
+
+class Journal(object):
+
+    def __init__(self, path, serial, counts, resume=False):
+        """Open the journal at path
+
+        When resuming, the steps recorded by an earlier run for the same
+        device and counts count as completed. Otherwise any earlier journal
+        is discarded.
+        """
+        self.path = path
+        self.header = {'serial': serial, 'counts': counts}
+        self.completed = []
+        self._file = None
+        self._lock = threading.Lock()
+        if resume:
+            self._load()
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        entries = []
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # the last line may have been cut short
+                    break
+        if entries and entries[0] == self.header:
+            self.completed = [entry['step'] for entry in entries[1:]]
+
+    def __contains__(self, step):
+        return step in self.completed
+
+    def record(self, step):
+        with self._lock:
+            if self._file is None:
+                if not os.path.isdir(os.path.dirname(self.path)):
+                    os.makedirs(os.path.dirname(self.path))
+                # rewrite what was loaded, dropping any partial last line
+                self._file = open(self.path, 'w')
+                self._write(self.header)
+                for completed in self.completed:
+                    self._write({'step': completed})
+            self._write({'step': step})
+            self.completed.append(step)
+
+    def _write(self, entry):
+        self._file.write('%s\n' % json.dumps(entry))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def remove(self):
+        """Discard the journal once the population has completed"""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if os.path.exists(self.path):
+                os.remove(self.path)
@@ -0,0 +1,82 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Timing and throughput of the phases of a population
+
+Every time a phase such as extracting a database or pushing a file runs,
+its wall time, bytes moved and item count are emitted as a structured log
+event and added to the totals for that phase.
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import json
+import threading
+import time
+
+
+class Metrics(object):
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.phases = OrderedDict()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name, bytes=0, items=1):
+        """Time the enclosed block as a phase
+
+        The yielded dict can be used to update the bytes and items once
+        they are known.
+        """
+        record = {'bytes': bytes, 'items': items}
+        start = time.time()
+        yield record
+        self.add(name, time.time() - start, record['bytes'], record['items'])
+
+    def add(self, name, duration, bytes=0, items=1):
+        with self._lock:
+            totals = self.phases.setdefault(name, {
+                'count': 0, 'duration': 0, 'bytes': 0, 'items': 0})
+            totals['count'] += 1
+            totals['duration'] += duration
+            totals['bytes'] += bytes
+            totals['items'] += items
+        message = '%s: %d items (%d bytes) in %.2fs' % (
+            name, items, bytes, duration)
+        if hasattr(self.logger, 'log_raw'):
+            self.logger.log_raw({'action': 'log',
+                                 'level': 'INFO',
+                                 'message': message,
+                                 'phase': name,
+                                 'duration': round(duration, 3),
+                                 'bytes': bytes,
+                                 'items': items})
+        else:
+            self.logger.debug(message)
+
+    def summary(self):
+        """Return the totals of each phase along with its throughput"""
+        with self._lock:
+            phases = OrderedDict()
+            for name, totals in self.phases.items():
+                phases[name] = dict(totals)
+                phases[name]['throughput'] = round(
+                    totals['bytes'] / totals['duration'], 1) if \
+                    totals['duration'] else 0
+                phases[name]['duration'] = round(totals['duration'], 3)
+        return phases
+
+    def report(self):
+        for name, totals in self.summary().items():
+            self.logger.info(
+                '%s: %d times, %d items (%d bytes) in %.2fs (%.1f KB/s)' % (
+                    name, totals['count'], totals['items'], totals['bytes'],
+                    totals['duration'], totals['throughput'] / 1024.0))
+
+    def write(self, path, **extra):
+        data = OrderedDict(extra)
+        data['phases'] = self.summary()
+        with open(path, 'w') as f:
+            json.dump(data, f, indent=2)
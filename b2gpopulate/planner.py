@@ -0,0 +1,142 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Scheduling of population steps as a dependency graph
+
+Each step runs in a lane. Steps in the device lane run one at a time as
+they all talk to the same device, whereas host steps such as extracting
+databases or tagging music run alongside them as soon as their
+dependencies have finished. This lets host side preparation overlap with
+B2G stopping and starting.
+"""
+
+import sys
+import threading
+import time
+
+DEVICE = 'device'
+HOST = 'host'
+
+
+class Step(object):
+
+    def __init__(self, name, func, lane, after, estimate, resumable):
+        self.name = name
+        self.func = func
+        self.lane = lane
+        self.after = after
+        self.estimate = estimate
+        self.resumable = resumable
+        self.done = threading.Event()
+        self.error = None
+
+
+class Plan(object):
+
+    def __init__(self, logger, host_jobs=1, journal=None):
+        self.logger = logger
+        self.host_jobs = max(1, host_jobs)
+        self.journal = journal
+        self.steps = []
+
+    def add(self, name, func, lane=DEVICE, after=(), estimate=0,
+            resumable=False):
+        """Add a step that runs once every step in after has finished
+
+        Resumable steps are recorded in the journal once they complete, and
+        skipped if an earlier run already recorded them. Returns the step so
+        that later steps can depend on it.
+        """
+        after = [step for step in after if step is not None]
+        step = Step(name, func, lane, after, estimate, resumable)
+        self.steps.append(step)
+        return step
+
+    def schedule(self):
+        """Return the estimated (start, finish) of each step and the path
+        of steps that determines the total time"""
+        lanes = {DEVICE: [(0, None)], HOST: [(0, None)] * self.host_jobs}
+        times = {}
+        blockers = {}
+        # steps are always added after their dependencies
+        for step in self.steps:
+            ready, blocker = 0, None
+            for dependency in step.after:
+                if times[dependency][1] >= ready:
+                    ready, blocker = times[dependency][1], dependency
+            slots = lanes[step.lane]
+            slot = min(range(len(slots)), key=lambda i: slots[i][0])
+            if slots[slot][0] > ready:
+                ready, blocker = slots[slot]
+            times[step] = (ready, ready + step.estimate)
+            blockers[step] = blocker
+            slots[slot] = (times[step][1], step)
+        path = []
+        step = self.steps and max(self.steps, key=lambda s: times[s][1])
+        while step:
+            path.insert(0, step)
+            step = blockers[step]
+        return times, path
+
+    def format(self):
+        times, path = self.schedule()
+        total = path and times[path[-1]][1] or 0
+        lines = ['Plan (estimated %.1fs):' % total]
+        for step in sorted(self.steps, key=lambda s: times[s]):
+            lines.append('  %6.1fs %6.1fs  %-6s  %s' % (
+                times[step][0], times[step][1], step.lane, step.name))
+        lines.append('Critical path: %s (%.1fs)' % (
+            ' -> '.join([step.name for step in path]), total))
+        return '\n'.join(lines)
+
+    def run(self):
+        """Run every step, raising the first error once all have stopped
+
+        Steps that depend on a failed step are skipped.
+        """
+        locks = {DEVICE: threading.Semaphore(1),
+                 HOST: threading.Semaphore(self.host_jobs)}
+        errors = []
+
+        def run_step(step):
+            try:
+                for dependency in step.after:
+                    dependency.done.wait()
+                    if dependency.error is not None:
+                        step.error = dependency.error
+                        self.logger.debug('Skipping %s' % step.name)
+                        return
+                resumable = step.resumable and self.journal is not None
+                if resumable and step.name in self.journal:
+                    self.logger.info('Skipping %s, completed by an earlier '
+                                     'run' % step.name)
+                    return
+                with locks[step.lane]:
+                    self.logger.debug('Starting %s' % step.name)
+                    start = time.time()
+                    step.func()
+                    self.logger.debug('Finished %s in %.2fs' % (
+                        step.name, time.time() - start))
+                if resumable:
+                    self.journal.record(step.name)
+            except Exception as e:
+                step.error = e
+                errors.append(sys.exc_info())
+            finally:
+                step.done.set()
+
+        threads = [threading.Thread(target=run_step, args=(step,))
+                   for step in self.steps]
+        start = time.time()
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            # joining with a timeout lets KeyboardInterrupt through
+            while thread.is_alive():
+                thread.join(0.5)
+        self.logger.debug('Ran %d steps in %.2fs' % (
+            len(self.steps), time.time() - start))
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
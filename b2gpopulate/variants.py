@@ -0,0 +1,131 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Distinct copies of a picture or video without re-encoding it
+
+The source file is parsed once into the parts that are shared by every
+copy, and each copy is then assembled in memory around metadata of its own.
+A JPEG picture is given a comment segment after its JFIF and Exif segments.
+A 3GP or MP4 video is given a title in the user data of its movie box when
+that box follows the media data, so that no chunk offsets move. Otherwise
+the title is carried by a free box appended to the file.
+"""
+
+import os
+import struct
+
+JPEG_EXTENSIONS = ['.jpg', '.jpeg']
+ISO_MEDIA_EXTENSIONS = ['.3gp', '.mp4', '.m4v']
+
+# JPEG markers
+SOI = '\xff\xd8'
+COM = '\xff\xfe'
+APP0 = 0xe0
+APP15 = 0xef
+
+# packed ISO 639-2 code for an undetermined language
+LANGUAGE_UNDETERMINED = 0x55c4
+
+
+class UnsupportedMediaError(Exception):
+    pass
+
+
+class JpegTemplate(object):
+
+    def __init__(self, data):
+        if not data.startswith(SOI):
+            raise UnsupportedMediaError('Not a JPEG file')
+        pos = len(SOI)
+        # readers expect the application segments straight after SOI
+        while data[pos:pos + 1] == '\xff' and \
+                APP0 <= ord(data[pos + 1:pos + 2] or '\x00') <= APP15:
+            length, = struct.unpack('>H', data[pos + 2:pos + 4])
+            pos += 2 + length
+        self.head = data[:pos]
+        self.tail = data[pos:]
+
+    def render(self, text):
+        """Return a copy of the picture with text as its comment"""
+        if len(text) > 0xffff - 2:
+            raise UnsupportedMediaError('Comment is too long')
+        return ''.join([self.head, COM, struct.pack('>H', len(text) + 2),
+                        text, self.tail])
+
+
+def _boxes(data, start, end):
+    """Yield the type, offset, size and header size of each box"""
+    pos = start
+    while pos + 8 <= end:
+        size, box_type = struct.unpack('>I4s', data[pos:pos + 8])
+        header = 8
+        if size == 1:
+            size, = struct.unpack('>Q', data[pos + 8:pos + 16])
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header or pos + size > end:
+            raise UnsupportedMediaError('Invalid %r box at %d' % (
+                box_type, pos))
+        yield box_type, pos, size, header
+        pos += size
+
+
+def _box(box_type, payload):
+    return struct.pack('>I4s', len(payload) + 8, box_type) + payload
+
+
+class IsoMediaTemplate(object):
+
+    def __init__(self, data):
+        boxes = list(_boxes(data, 0, len(data)))
+        types = [box[0] for box in boxes]
+        if 'moov' not in types:
+            raise UnsupportedMediaError('No movie box found')
+        index = types.index('moov')
+        self.data = data
+        self.grow_movie = 'mdat' not in types[index + 1:]
+        if not self.grow_movie:
+            return
+        moov_type, moov_offset, moov_size, moov_header = boxes[index]
+        self.head = data[:moov_offset]
+        self.tail = data[moov_offset + moov_size:]
+        self.children = []
+        self.user_data = []
+        for box_type, offset, size, header in _boxes(
+                data, moov_offset + moov_header, moov_offset + moov_size):
+            if box_type == 'udta':
+                self.user_data.append(
+                    data[offset + header:offset + size])
+            else:
+                self.children.append(data[offset:offset + size])
+
+    def render(self, text):
+        """Return a copy of the video with text as its title"""
+        text = text.encode('utf-8') if isinstance(text, unicode) else text
+        title = _box('titl', struct.pack(
+            '>IH', 0, LANGUAGE_UNDETERMINED) + text + '\x00')
+        if not self.grow_movie:
+            return self.data + _box('free', title)
+        user_data = _box('udta', ''.join(self.user_data + [title]))
+        return ''.join([self.head,
+                        _box('moov', ''.join(self.children + [user_data])),
+                        self.tail])
+
+
+def template(filename, data):
+    """Return the template of a picture or video, by its extension"""
+    extension = os.path.splitext(filename)[1].lower()
+    if extension in JPEG_EXTENSIONS:
+        return JpegTemplate(data)
+    if extension in ISO_MEDIA_EXTENSIONS:
+        return IsoMediaTemplate(data)
+    raise UnsupportedMediaError('Unable to make variants of %s' % filename)
+
+
+def copies(filename, data, count):
+    """Yield count distinct copies of a picture or video"""
+    media = template(filename, data)
+    for i in range(1, count + 1):
+        yield media.render('Copy %d of %s' % (i, filename))
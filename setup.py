@@ -33,9 +33,9 @@ setup(name='b2gpopulate',
       packages=['b2gpopulate'],
       package_data={'b2gpopulate': [
           'resources/contactsDb.zip',
-          'resources/dialerDb.zip',
+          'resources/dialerDb.delta',
           'resources/smsAttachments.zip',
-          'resources/smsDb.zip',
+          'resources/smsDb.delta',
           'resources/IMG_0001.jpg',
           'resources/MUS_0001.mp3',
           'resources/VID_0001.3gp']},
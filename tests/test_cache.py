@@ -0,0 +1,52 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from b2gpopulate.b2gpopulate import B2GPopulate
+from b2gpopulate.b2gpopulate import ResourceCache
+from b2gpopulate.benchmark import SimulatedDevice
+from b2gpopulate.benchmark import SimulatedDeviceManager
+from b2gpopulate.benchmark import SimulatedMarionette
+
+
+class TestResourceCache(unittest.TestCase):
+
+    def setUp(self):
+        self.temp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp)
+
+    def test_entries_in_use_are_kept(self):
+        cache = ResourceCache(self.temp, max_size=1024)
+        tracks = cache.music(20)
+        archive = cache.archive(tracks)
+        self.assertTrue(os.path.isdir(tracks))
+        self.assertEqual(cache.evictions, 0)
+
+        cache.release(archive)
+        self.assertFalse(os.path.exists(archive))
+        self.assertTrue(os.path.isdir(tracks))
+        cache.release(tracks)
+        self.assertEqual([entry[0] for entry in cache.entries()], [])
+        self.assertEqual(cache.evictions, 2)
+
+    def test_populate_larger_than_cache(self):
+        manager = SimulatedDeviceManager(latency=0)
+        self.addCleanup(manager.cleanup)
+        cache = ResourceCache(os.path.join(self.temp, 'cache'),
+                              max_size=1024 * 1024)
+        b2gpopulate = B2GPopulate(
+            SimulatedMarionette(manager),
+            device=SimulatedDevice(manager, stop_time=0, start_time=0),
+            resources=cache)
+        b2gpopulate.populate(message_count=200, music_count=20)
+        b2gpopulate.verify_counts(message_count=200, music_count=20)
+        self.assertTrue(cache.stats()['size'] <= cache.max_size)
+
+
+if __name__ == '__main__':
+    unittest.main()
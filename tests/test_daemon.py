@@ -0,0 +1,128 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+
+from b2gpopulate import daemon
+
+COUNTS = {'call_count': 50, 'message_count': 200, 'music_count': 3,
+          'picture_count': 4, 'video_count': 2}
+
+
+class TestDaemon(unittest.TestCase):
+
+    def setUp(self):
+        self.populators = []
+        self.daemon = daemon.Daemon(factory=self.populator)
+
+    def tearDown(self):
+        self.daemon.close()
+        for populator in self.populators:
+            populator.device.manager.cleanup()
+
+    def populator(self, serial, address):
+        populator = daemon.simulated_populator(
+            serial, address, latency=0, stop_time=0, start_time=0)
+        self.populators.append(populator)
+        return populator
+
+    def populate(self, **request):
+        request.update({'command': 'populate', 'serial': 'simulated',
+                        'counts': COUNTS, 'wait': True})
+        return self.daemon.handle(request)
+
+    def test_warm_session(self):
+        cold = self.populate(options={'incremental': True})
+        self.assertEqual(cold['status'], 'done', cold['error'])
+        self.assertFalse(cold['warm'])
+        self.assertTrue(cold['bytes_sent'] > 0)
+
+        warm = self.populate(options={'incremental': True})
+        self.assertEqual(warm['status'], 'done', warm['error'])
+        self.assertTrue(warm['warm'])
+        self.assertEqual(warm['bytes_sent'], 0)
+        self.assertTrue(warm['bytes_skipped'] > 0)
+        self.assertEqual(len(self.populators), 1)
+
+        status = self.daemon.handle({'command': 'status',
+                                     'job': warm['job']})
+        self.assertEqual(status['status'], 'done')
+        sessions = self.daemon.handle({'command': 'sessions'})['sessions']
+        self.assertEqual([s['jobs_run'] for s in sessions], [2])
+
+    def test_invalid_requests(self):
+        for request, error in [
+                ({}, 'Unknown command: None'),
+                ({'command': 'format'}, 'Unknown command: format'),
+                ({'command': 'populate', 'workload': 'huge'},
+                 'Unknown workload: huge'),
+                ({'command': 'populate', 'counts': {'fax_count': 1}},
+                 'Unknown count: fax_count'),
+                ({'command': 'populate', 'counts': {'call_count': -1}},
+                 'Invalid value for call_count'),
+                ({'command': 'populate', 'counts': {}},
+                 'Must specify at least one item to populate'),
+                ({'command': 'populate', 'counts': {'call_count': 1},
+                  'options': {'reboot': True}},
+                 'Unknown option: reboot'),
+                ({'command': 'restore'},
+                 'Please specify an image to restore'),
+                ({'command': 'status', 'job': 42}, 'Unknown job: 42'),
+                ({'command': 'status', 'job': [1]},
+                 'Invalid value for job'),
+                ({'command': 'wait', 'job': 42, 'timeout': 'soon'},
+                 'Unknown job: 42'),
+                ({'command': 'populate', 'workload': ['light']},
+                 'Invalid value for workload'),
+                ({'command': 'populate', 'counts': [1]},
+                 'Invalid value for counts'),
+                ({'command': 'populate', 'counts': {'call_count': '1'}},
+                 'Invalid value for call_count'),
+                ({'command': 'populate', 'counts': {'call_count': True}},
+                 'Invalid value for call_count'),
+                ({'command': 'populate', 'counts': {'call_count': 1},
+                  'options': ['incremental']},
+                 'Invalid value for options'),
+                ({'command': 'populate', 'counts': {'call_count': 1},
+                  'serial': ['simulated']},
+                 'Invalid value for serial'),
+                ({'command': 'restore', 'image': 1},
+                 'Invalid value for image'),
+                ({'command': 'close', 'serial': 'simulated'},
+                 'There is no session for simulated')]:
+            self.assertEqual(self.daemon.handle(request), {'error': error})
+        self.assertEqual(self.daemon.sessions, {})
+
+    def test_invalid_timeout(self):
+        job = self.populate()
+        for timeout in ['soon', [1], -1]:
+            self.assertEqual(
+                self.daemon.handle({'command': 'wait', 'job': job['job'],
+                                    'timeout': timeout}),
+                {'error': 'Invalid value for timeout'})
+
+    def test_failed_job(self):
+        failed = self.daemon.handle({'command': 'restore',
+                                     'serial': 'simulated',
+                                     'image': '/nonexistent.zip',
+                                     'wait': True})
+        self.assertEqual(failed['status'], 'failed')
+        self.assertTrue(failed['error'])
+        sessions = self.daemon.handle({'command': 'sessions'})['sessions']
+        self.assertFalse(sessions[0]['connected'])
+
+    def test_shutdown(self):
+        job = self.populate()
+        self.assertEqual(job['status'], 'done', job['error'])
+        session = self.daemon.sessions.values()[0]
+        self.assertEqual(self.daemon.handle({'command': 'shutdown'}),
+                         {'shutdown': True})
+        self.assertEqual(self.daemon.sessions, {})
+        self.assertFalse(session.thread.is_alive())
+        self.assertEqual(
+            self.daemon.handle({'command': 'sessions'}), {'sessions': []})
+
+
+if __name__ == '__main__':
+    unittest.main()
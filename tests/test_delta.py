@@ -0,0 +1,41 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import unittest
+from zipfile import ZipFile
+
+from b2gpopulate import delta
+
+RESOURCES = os.path.join(os.path.dirname(__file__), os.pardir,
+                         'b2gpopulate', 'resources')
+
+
+class TestStore(unittest.TestCase):
+
+    def assertStoreMatchesZip(self, name):
+        store = delta.Store(os.path.join(RESOURCES, '%s.delta' % name))
+        archive = ZipFile(os.path.join(RESOURCES, '%s.zip' % name))
+        names = sorted([member for member in archive.namelist()
+                        if not member.endswith('/')])
+        self.assertEqual(sorted(store.namelist()), names)
+        for member in names:
+            info = archive.getinfo(member)
+            self.assertEqual(store.getinfo(member).file_size, info.file_size)
+            self.assertEqual(store.getinfo(member).CRC, info.CRC)
+            self.assertEqual(store.read(member), archive.read(member))
+
+    def test_sms_store(self):
+        self.assertStoreMatchesZip('smsDb')
+
+    def test_dialer_store(self):
+        self.assertStoreMatchesZip('dialerDb')
+
+    def test_unknown_member(self):
+        store = delta.Store(os.path.join(RESOURCES, 'smsDb.delta'))
+        self.assertRaises(KeyError, store.read, 'missing.sqlite')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from mutagen.easyid3 import EasyID3
+from mutagen.mp3 import MP3
+
+from b2gpopulate import id3
+from b2gpopulate.b2gpopulate import LocalResources
+
+RESOURCES = os.path.join(os.path.dirname(__file__), os.pardir,
+                         'b2gpopulate', 'resources')
+SOURCE = os.path.join(RESOURCES, 'MUS_0001.mp3')
+
+
+class TestTracks(unittest.TestCase):
+
+    def setUp(self):
+        self.temp = tempfile.mkdtemp()
+        with open(SOURCE, 'rb') as f:
+            self.data = f.read()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp)
+
+    def tags(self, path):
+        tags = EasyID3(path)
+        return dict([(name, tags[name]) for name in
+                     ['title', 'artist', 'album', 'tracknumber']])
+
+    def expected(self, count, tracks_per_album):
+        return [{'title': [u'Track %d' % (i % tracks_per_album + 1)],
+                 'artist': [u'Artist %d' % (i / tracks_per_album + 1)],
+                 'album': [u'Album %d' % (i / tracks_per_album + 1)],
+                 'tracknumber': [u'%d' % (i % tracks_per_album + 1)]}
+                for i in range(count)]
+
+    def test_tracks(self):
+        tags = []
+        for i, track in enumerate(id3.tracks(self.data, 12, 5)):
+            path = os.path.join(self.temp, '%d.mp3' % i)
+            with open(path, 'wb') as f:
+                f.write(track)
+            tags.append(self.tags(path))
+            # the audio is untouched, so it still decodes to the same length
+            self.assertAlmostEqual(MP3(path).info.length,
+                                   MP3(SOURCE).info.length)
+        self.assertEqual(tags, self.expected(12, 5))
+
+    def test_untagged_source(self):
+        template = id3.Template(self.data)
+        path = os.path.join(self.temp, 'untagged.mp3')
+        with open(path, 'wb') as f:
+            f.write(template.audio)
+        track, = id3.tracks(template.audio, 1)
+        with open(path, 'wb') as f:
+            f.write(track)
+        self.assertEqual([self.tags(path)], self.expected(1, 10))
+
+    def test_tagged_with_mutagen(self):
+        resources = LocalResources(os.path.join(self.temp, 'resources'))
+        path = os.path.join(self.temp, 'mutagen')
+        os.mkdir(path)
+        resources._tag_with_mutagen(SOURCE, path, 12, 5)
+        tags = [self.tags(os.path.join(path, 'MUS_0001_%d.mp3' % i))
+                for i in range(1, 13)]
+        self.assertEqual(tags, self.expected(12, 5))
+
+
+if __name__ == '__main__':
+    unittest.main()
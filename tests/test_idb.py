@@ -0,0 +1,121 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from b2gpopulate import delta
+from b2gpopulate import idb
+
+RESOURCES = os.path.join(os.path.dirname(__file__), os.pardir,
+                         'b2gpopulate', 'resources')
+
+
+class TestIndexedDB(unittest.TestCase):
+
+    def setUp(self):
+        self.temp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp)
+
+    def database(self, store, name):
+        """Return the path of a prebuilt database rebuilt from its store"""
+        path = os.path.join(self.temp, name)
+        with open(path, 'wb') as f:
+            f.write(delta.Store(os.path.join(
+                RESOURCES, '%s.delta' % store)).read(name))
+        return path
+
+    def connect(self, path):
+        db = sqlite3.connect(path)
+        db.text_factory = str
+        self.addCleanup(db.close)
+        return db
+
+    def test_round_trip(self):
+        for store in ['smsDb', 'dialerDb']:
+            for name in delta.Store(os.path.join(
+                    RESOURCES, '%s.delta' % store)).namelist():
+                db = self.connect(self.database(store, name))
+                for key, data in db.execute(
+                        'SELECT key_value, data FROM object_data'):
+                    key, data = str(key), str(data)
+                    value = idb.decode_value(data)
+                    self.assertEqual(idb.decode_value(idb.encode_value(
+                        value)), value)
+                    writer = idb._CloneWriter()
+                    writer.write(value)
+                    self.assertEqual(''.join(writer.out),
+                                     idb.snappy_decompress(data))
+                    self.assertEqual(idb.encode_key(idb.decode_key(key)),
+                                     key)
+
+    def test_snappy_round_trip(self):
+        data = 'b2gpopulate ' * 1000 + ''.join(map(chr, range(256)))
+        self.assertEqual(idb.snappy_decompress(idb.snappy_compress(data)),
+                         data)
+
+    def test_generate(self):
+        for store, name, store_name, count, descending in [
+                ('smsDb', 'smsDb-200.sqlite', 'sms', 1000, False),
+                ('dialerDb', 'dialerDb-50.sqlite', 'dialerRecents', 130,
+                 True)]:
+            destination = os.path.join(self.temp, 'generated-%s' % name)
+            idb.generate(self.database(store, name), destination,
+                         store_name, count, descending, batch_size=100)
+            self.assertEqual(idb.count_records(destination, store_name),
+                             count)
+            db = self.connect(destination)
+            self.assertEqual(
+                db.execute('PRAGMA integrity_check').fetchall(), [('ok', )])
+            self.assertEqual(db.execute(
+                'SELECT COUNT(DISTINCT key_value) FROM object_data '
+                'JOIN object_store ON object_store.id = object_store_id '
+                'WHERE object_store.name = ?', (store_name, )).fetchone(),
+                (count, ))
+            self.assertEqual(db.execute(
+                'SELECT index_id, value FROM unique_index_data '
+                'GROUP BY index_id, value HAVING COUNT(*) > 1').fetchall(),
+                [])
+
+    def test_generate_unique_index(self):
+        destination = os.path.join(self.temp, 'smsDb.sqlite')
+        template = self.database('smsDb', 'smsDb-200.sqlite')
+        idb.generate(template, destination, 'sms', 1000)
+        counts = []
+        for path in [template, destination]:
+            db = self.connect(path)
+            index_id, key_path = db.execute(
+                'SELECT id, key_path FROM object_store_index '
+                'WHERE unique_index = 1').fetchone()
+            keys = [idb.get_key_path(idb.decode_value(str(data)), key_path)
+                    for data, in db.execute('SELECT data FROM object_data '
+                                            'WHERE object_store_id = 1')]
+            counts.append((len([k for k in keys if idb.is_valid_key(k)]),
+                           db.execute('SELECT COUNT(*) FROM unique_index_data '
+                                      'WHERE index_id = ?',
+                                      (index_id, )).fetchone()[0]))
+        self.assertTrue(counts[0][0] > 0)
+        # every record with a key has its own entry in the index
+        self.assertEqual(counts[1][0], counts[1][1])
+        self.assertTrue(counts[1][0] > counts[0][0])
+
+    def test_unique_array(self):
+        value = [1, u'a', True, idb.Date(5)]
+        self.assertEqual(idb._unique(value, 2, 10),
+                         [21, u'a-2', True, idb.Date(25)])
+        self.assertEqual(idb._unique(value, 2, 10, descending=True),
+                         [-19, u'a-2', True, idb.Date(-15)])
+        self.assertEqual(idb._span([[1, 5], 3, True]), 5)
+        keys = [idb.index_keys({'a': idb._unique([1, 2], i, 2)}, 'a', True)
+                for i in range(3)]
+        self.assertEqual(len(set(sum(keys, []))), 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from b2gpopulate.b2gpopulate import B2GPopulate
+from b2gpopulate.b2gpopulate import LocalResources
+from b2gpopulate.benchmark import SimulatedDevice
+from b2gpopulate.benchmark import SimulatedDeviceManager
+from b2gpopulate.benchmark import SimulatedMarionette
+
+COUNTS = {'call_count': 50,
+          'message_count': 200,
+          'music_count': 3,
+          'picture_count': 4,
+          'video_count': 2}
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.temp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp)
+
+    def populate(self, unzip):
+        manager = SimulatedDeviceManager(latency=0, unzip=unzip)
+        self.addCleanup(manager.cleanup)
+        b2gpopulate = B2GPopulate(
+            SimulatedMarionette(manager),
+            device=SimulatedDevice(manager, stop_time=0, start_time=0),
+            resources=LocalResources(os.path.join(self.temp, 'resources')))
+        b2gpopulate.populate(**COUNTS)
+        return manager, b2gpopulate
+
+    def round_trip(self, unzip):
+        manager, b2gpopulate = self.populate(unzip)
+        files = dict(manager.files)
+        image = os.path.join(self.temp, 'snapshot.zip')
+        b2gpopulate.snapshot(image)
+
+        # wipe everything that was populated
+        for path in [manager.deviceRoot, B2GPopulate.STORAGE_PATH]:
+            manager._remove(path)
+        b2gpopulate.reset(resources=LocalResources(
+            os.path.join(self.temp, 'restore')))
+        b2gpopulate.verify_counts(music_count=0, picture_count=0,
+                                  video_count=0)
+        for data_type in ['call', 'message']:
+            self.assertFalse(b2gpopulate.database_destination(
+                data_type) in manager.files)
+
+        b2gpopulate.restore(image)
+        b2gpopulate.verify_counts(**COUNTS)
+        self.assertEqual(manager.files, files)
+
+    def test_round_trip(self):
+        self.round_trip(unzip=True)
+
+    def test_round_trip_without_unzip(self):
+        self.round_trip(unzip=False)
+
+
+if __name__ == '__main__':
+    unittest.main()